@@ -0,0 +1,152 @@
+import asyncio
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, Optional, Tuple, Union
+
+from pydantic import BaseModel
+
+from chatgpt import ChatGPTSession
+from simpleaichat import ModelSessionFactory
+
+
+class BatchResult(BaseModel):
+    index: int
+    prompt: str
+    session: Any = None
+    response: Optional[str] = None
+    error: Optional[str] = None
+    elapsed: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class BatchStats(BaseModel):
+    count: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    @property
+    def requests_per_sec(self) -> float:
+        return self.count / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def tokens_per_sec(self) -> float:
+        return (self.prompt_tokens + self.completion_tokens) / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.count:,} requests ({self.errors:,} errors) in {self.elapsed:.2f}s: "
+                f"{self.requests_per_sec:.2f} req/s, {self.prompt_tokens:,} prompt + "
+                f"{self.completion_tokens:,} completion tokens, {self.tokens_per_sec:.1f} tok/s")
+
+
+BatchItem = Tuple[Union[Dict[str, Any], ChatGPTSession], str]
+
+
+class BatchRunner:
+    """Run many (session-config, prompt) pairs with at most `concurrency` requests in flight.
+
+    A session-config is either a ChatGPTSession or kwargs for session_factory.
+    Results stream back in completion order, or in input order with ordered=True;
+    every reply is saved into its session history as usual, so a session
+    should not be used by two items at the same time.
+    """
+
+    def __init__(self, concurrency: int = 8, ordered: bool = False,
+                 session_factory: Callable[..., ChatGPTSession] = ModelSessionFactory.buildChatGPTSession,
+                 **call_kwargs):
+        self.concurrency = max(1, concurrency)
+        self.ordered = ordered
+        self.session_factory = session_factory
+        self.call_kwargs = call_kwargs
+        self.stats = BatchStats()
+
+    def _session(self, config) -> ChatGPTSession:
+        return config if isinstance(config, ChatGPTSession) else self.session_factory(**config)
+
+    def _result(self, index, session, prompt, started, prompt_tokens, completion_tokens, response=None, error=None):
+        return BatchResult(index=index, prompt=prompt, session=session, response=response, error=error,
+                           elapsed=time.perf_counter() - started,
+                           prompt_tokens=session.total_prompt_length - prompt_tokens,
+                           completion_tokens=session.total_completion_length - completion_tokens)
+
+    def run_one(self, index: int, config, prompt: str) -> BatchResult:
+        session = self._session(config)
+        started = time.perf_counter()
+        p, c = session.total_prompt_length, session.total_completion_length
+        try:
+            response = "".join(r for r in session(prompt, **self.call_kwargs) if isinstance(r, str))
+            return self._result(index, session, prompt, started, p, c, response=response)
+        except Exception as e:
+            return self._result(index, session, prompt, started, p, c, error=repr(e))
+
+    async def arun_one(self, index: int, config, prompt: str) -> BatchResult:
+        session = self._session(config)
+        started = time.perf_counter()
+        p, c = session.total_prompt_length, session.total_completion_length
+        try:
+            response = "".join([r async for r in session.acall(prompt, **self.call_kwargs) if isinstance(r, str)])
+            return self._result(index, session, prompt, started, p, c, response=response)
+        except Exception as e:
+            return self._result(index, session, prompt, started, p, c, error=repr(e))
+
+    def _reorder(self, done: Iterable[BatchResult], pending: Dict[int, BatchResult], next_index: int):
+        # buffers out of order results until the next input index is available
+        done = list(done)
+        for r in done:
+            self.stats.count += 1
+            self.stats.errors += r.error is not None
+            self.stats.prompt_tokens += r.prompt_tokens
+            self.stats.completion_tokens += r.completion_tokens
+        if not self.ordered:
+            return done, next_index
+        for r in done:
+            pending[r.index] = r
+        ready = []
+        while next_index in pending:
+            ready.append(pending.pop(next_index))
+            next_index += 1
+        return ready, next_index
+
+    def run(self, items: Iterable[BatchItem]) -> Iterator[BatchResult]:
+        self.stats = BatchStats()
+        started = time.perf_counter()
+        items = iter(enumerate(items))
+        pending, next_index = {}, 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            running = set()
+            for index, (config, prompt) in items:
+                running.add(pool.submit(self.run_one, index, config, prompt))
+                if len(running) < self.concurrency:
+                    continue
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                ready, next_index = self._reorder((f.result() for f in finished), pending, next_index)
+                self.stats.elapsed = time.perf_counter() - started
+                yield from ready
+            while running:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                ready, next_index = self._reorder((f.result() for f in finished), pending, next_index)
+                self.stats.elapsed = time.perf_counter() - started
+                yield from ready
+
+    async def arun(self, items: Iterable[BatchItem]) -> AsyncIterator[BatchResult]:
+        self.stats = BatchStats()
+        started = time.perf_counter()
+        pending, next_index = {}, 0
+        running = set()
+        for index, (config, prompt) in enumerate(items):
+            running.add(asyncio.ensure_future(self.arun_one(index, config, prompt)))
+            if len(running) < self.concurrency:
+                continue
+            finished, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            ready, next_index = self._reorder((t.result() for t in finished), pending, next_index)
+            self.stats.elapsed = time.perf_counter() - started
+            for r in ready:
+                yield r
+        while running:
+            finished, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            ready, next_index = self._reorder((t.result() for t in finished), pending, next_index)
+            self.stats.elapsed = time.perf_counter() - started
+            for r in ready:
+                yield r
@@ -0,0 +1,418 @@
+import sys
+import time
+from typing import Dict, Tuple
+import fire
+
+from models import CommonMessage, Function
+from utils import clear_token_encoders, warmup_token_encoders
+from simpleaichat import ModelSessionFactory
+
+SAMPLE_TEXT = "The quick brown fox jumps over the lazy dog. " * 8
+
+
+def _timeit(func, n):
+    start = time.perf_counter()
+    for i in range(n):
+        func(i)
+    return (time.perf_counter() - start) / n
+
+
+def bench_add_msg(n: int = 200, model: str = 'gpt-3.5-turbo-16k'):
+    """per-message add_msg cost, tiktoken.encoding_for_model on every call vs the encoder registry"""
+    import tiktoken
+    ss = ModelSessionFactory.buildChatGPTSession(model=model)
+
+    def uncached_encoder():
+        try:
+            return tiktoken.encoding_for_model(model.replace('-16k',''))
+        except Exception:
+            return None
+
+    ss.messages = []
+    before = _timeit(lambda i:ss.add_msg(CommonMessage(role='user',content=SAMPLE_TEXT).calc_tokens(uncached_encoder())), n)
+
+    clear_token_encoders()
+    if not warmup_token_encoders([model.replace('-16k','')])[model.replace('-16k','')] or uncached_encoder() is None:
+        # with no encoder both sides would time add_msg without any encoding
+        print(f"add_msg x{n} ({model}): no tiktoken encoder (offline?), nothing to compare")
+        return
+    ss.messages = []
+    after = _timeit(lambda i:ss.add_msg({'user':SAMPLE_TEXT}), n)
+
+    print(f"add_msg x{n} ({model})")
+    print(f"  before: {before*1e6:,.1f} us/msg")
+    print(f"  after : {after*1e6:,.1f} us/msg ({before/after:,.1f}x)")
+
+
+def bench_messages_dict(sizes=(1000, 10000), turns: int = 20):
+    """payload build per turn, model_dump on the full history vs memoized wire dicts"""
+    fields = {"role", "content", "name"}
+    for size in sizes:
+        ss = ModelSessionFactory.buildChatGPTSession()
+        for i in range(size):
+            ss.add_msg({'user' if i%2==0 else 'assistant':SAMPLE_TEXT})
+
+        def dump_all(i):
+            ss.add_msg({'user':SAMPLE_TEXT})
+            return [m.model_dump(include=fields, exclude_none=True) for m in [ss.system_message]+ss.messages]
+        before = _timeit(dump_all, turns)
+
+        ss.get_messages_dict()
+        def memoized(i):
+            ss.add_msg({'user':SAMPLE_TEXT})
+            return ss.get_messages_dict()
+        after = _timeit(memoized, turns)
+
+        print(f"get_messages_dict, {size:,} messages")
+        print(f"  before: {before*1e3:,.2f} ms/turn")
+        print(f"  after : {after*1e3:,.3f} ms/turn ({before/after:,.1f}x)")
+
+
+def bench_semantic_lookup(sizes=(10000, 100000), dim: int = 1536, queries: int = 200):
+    """SemanticCache.lookup latency over random unit vectors"""
+    import numpy as np
+    from semantic import SemanticCache
+
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        cache = SemanticCache(threshold=0.99)
+        vectors = rng.standard_normal((size, dim), dtype=np.float32)
+        for i in range(size):
+            cache.add('system', vectors[i], str(i))
+        probes = [vectors[rng.integers(size)] for i in range(queries)]
+        per_query = _timeit(lambda i:cache.lookup('system', probes[i]), queries)
+        print(f"semantic lookup, {size:,} entries x {dim} dims: {per_query*1e3:,.3f} ms/query, hit rate {cache.stats()['hit_rate']:.2f}")
+
+
+def _traced_size(build):
+    import tracemalloc
+    tracemalloc.start()
+    obj = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, obj
+
+
+def bench_history_memory(n: int = 20000, embedding_dim: int = 256):
+    """memory of a session history, list of CommonMessage vs ColumnarMessages"""
+    from columnar import ColumnarMessages
+
+    def messages():
+        for i in range(n):
+            m = CommonMessage(role='user' if i%2==0 else 'assistant', content=SAMPLE_TEXT, content_tokens=80,
+                              name=None if i%2==0 else 'GPT')
+            if embedding_dim:
+                m.embedding = [0.1] * embedding_dim
+            yield m
+
+    before, models = _traced_size(lambda:list(messages()))
+    del models
+    after, columns = _traced_size(lambda:ColumnarMessages(messages()))
+    print(f"history of {n:,} messages, {embedding_dim}-dim embeddings")
+    print(f"  list[CommonMessage]: {before/2**20:,.1f} MiB")
+    print(f"  ColumnarMessages   : {after/2**20:,.1f} MiB ({before/after:,.1f}x smaller)")
+
+
+def bench_persistence(n: int = 10000, turns: int = 20, path: str = None):
+    """checkpoint/load of a long session, full to_dict rewrite vs snapshot + journal"""
+    import orjson, os, shutil, tempfile
+    from persistence import SessionJournal
+
+    root = path or tempfile.mkdtemp()
+    ss = ModelSessionFactory.buildChatGPTSession()
+    for i in range(n):
+        ss.add_msg({'user' if i%2==0 else 'assistant':SAMPLE_TEXT})
+    ss.recent_messages = 20
+
+    full_path = os.path.join(root, 'full.json')
+    def full_save(i):
+        ss.add_msg({'user':SAMPLE_TEXT})
+        with open(full_path, 'wb') as f:
+            f.write(orjson.dumps(ss.to_dict(), default=str))
+    full_turn = _timeit(full_save, turns)
+    def full_load(i):
+        with open(full_path, 'rb') as f:
+            ss.load_from_dict(orjson.loads(f.read())).get_messages_dict()
+    full_load_time = _timeit(full_load, 3)
+
+    journal = SessionJournal(os.path.join(root, 'journal'), compact_every=10**9)
+    start = time.perf_counter()
+    journal.checkpoint(ss)
+    first = time.perf_counter() - start
+    def journal_save(i):
+        ss.add_msg({'user':SAMPLE_TEXT})
+        journal.checkpoint(ss)
+    journal_turn = _timeit(journal_save, turns)
+    start = time.perf_counter()
+    journal.compact()
+    compact = time.perf_counter() - start
+    def journal_load(i):
+        loaded = SessionJournal(journal.path).load()
+        loaded.recent_messages = 20
+        loaded.get_messages_dict()
+    journal_load_time = _timeit(journal_load, 3)
+
+    print(f"persistence, {len(ss.messages):,} messages")
+    print(f"  full rewrite : {full_turn*1e3:,.2f} ms/turn, load + window {full_load_time*1e3:,.1f} ms")
+    print(f"  journal      : {journal_turn*1e3:,.3f} ms/turn, load + window {journal_load_time*1e3:,.2f} ms")
+    print(f"  first checkpoint {n/first:,.0f} msg/s, compaction {len(ss.messages)/compact:,.0f} msg/s")
+    if path is None:
+        shutil.rmtree(root)
+
+
+def _synthetic_page(i: int, paragraphs: int, minified: bool = False) -> str:
+    # minified pages have no line breaks at all, every text node lands on one line
+    body = ("" if minified else "\n").join(
+        f"<div class='c{j%7}'><h2>Section {j}</h2><p>{SAMPLE_TEXT}  <a href='/p{j}'>link {j}</a></p>"
+        f"<script>var x{j} = {j};</script><ul><li>item {j}</li><li>  spaced  out  </li></ul></div>"
+        for j in range(paragraphs))
+    return f"<html><head><title>page {i}</title><style>.c0{{color:red}}</style></head><body>{body}</body></html>"
+
+
+def bench_html_to_text(corpus: str = None, pages: int = 10, paragraphs: int = 5000, max_chars: int = 20000):
+    """page text extraction per engine, over saved .html pages in `corpus` or synthetic ~2MB pages
+    (half of them minified to a single line)"""
+    import glob, os
+    from bs4 import BeautifulSoup
+    from extract import available_engines, html_to_text
+
+    if corpus:
+        docs = []
+        for p in sorted(glob.glob(os.path.join(corpus, "*.html"))):
+            with open(p, encoding="utf-8", errors="replace") as f:
+                docs.append(f.read())
+        groups = {corpus: docs}
+    else:
+        groups = {"multi-line": [_synthetic_page(i, paragraphs) for i in range(pages - pages // 2)],
+                  "single-line": [_synthetic_page(i, paragraphs, minified=True) for i in range(pages // 2)]}
+    if not any(groups.values()):
+        print(f"no .html files in {corpus}")
+        return
+
+    def original(html):
+        soup = BeautifulSoup(html, "html.parser")
+        for script in soup(["script", "style"]):
+            script.extract()
+        lines = (line.strip() for line in soup.get_text().splitlines())
+        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+        return "\n".join(chunk for chunk in chunks if chunk)
+
+    for name, docs in groups.items():
+        if not docs:
+            continue
+        size = sum(len(d) for d in docs)
+        print(f"html_to_text, {len(docs)} {name} pages, {size/len(docs)/2**20:,.2f} MiB/page")
+        before = _timeit(lambda i:original(docs[i]), len(docs))
+        print(f"  before (bs4 html.parser): {before*1e3:,.1f} ms/page")
+        for engine in available_engines():
+            full = _timeit(lambda i:html_to_text(docs[i], engine=engine), len(docs))
+            head = _timeit(lambda i:html_to_text(docs[i], max_chars, engine=engine), len(docs))
+            print(f"  {engine:10s}: {full*1e3:,.1f} ms/page ({before/full:,.1f}x), "
+                  f"first {max_chars:,} chars {head*1e3:,.1f} ms/page ({before/head:,.1f}x)")
+
+
+def bench_stream(words: int = 20000, max_chars: int = 1024, max_delay: float = 0.05, rounds: int = 3):
+    """streamed reply from a local SSE stand-in, one write per delta vs coalesced typed events"""
+    from pydantic import SecretStr
+    from mockserver import MockChatServer
+
+    reply = " ".join(f"w{i}" for i in range(words))
+    with MockChatServer(reply=reply) as server:
+        ss = ModelSessionFactory.buildChatGPTSession(api_url=server.url, auth={'api_key': SecretStr('sk-local')})
+        # the mock server answers stream_options like api.openai.com
+        ss.stream_usage = True
+
+        def run(consume):
+            writes, start = 0, time.perf_counter()
+            for i in range(rounds):
+                ss.messages = []
+                for chunk in consume():
+                    writes += 1
+            return writes / rounds, (time.perf_counter() - start) / rounds
+
+        plain_writes, plain = run(lambda:ss('hi', stream=True))
+        event_writes, events = run(lambda:ss.stream_events('hi', max_chars=max_chars, max_delay=max_delay))
+
+    print(f"stream of {words:,} deltas ({len(reply)/2**10:,.0f} KiB)")
+    print(f"  plain strings : {plain_writes:,.0f} writes, {plain*1e3:,.0f} ms, {words/plain:,.0f} deltas/s")
+    print(f"  coalesced     : {event_writes:,.0f} writes, {events*1e3:,.0f} ms, {words/events:,.0f} deltas/s "
+          f"({plain_writes/event_writes:,.0f}x fewer writes)")
+
+
+class BenchEcho(Function):
+    description: str = 'echo the text back'
+    _parameters_description = dict(
+        text='the text to echo'
+    )
+    def __call__(self, text: str):
+        return {"echo": text}
+
+    def __init__(self, *args,**kwargs):
+        super(self.__class__, self).__init__(*args,**kwargs)
+        self._extract_signature()
+
+
+SUITE_MODES = ("plain", "stream", "tools", "stream_tools")
+
+
+def _percentile(ordered, q):
+    # nearest rank on a sorted list
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def _rss_peak_mib():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # KiB on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def _suite_case(url, mode, history, concurrency, requests, trace_memory):
+    import tracemalloc
+    from concurrent.futures import ThreadPoolExecutor
+    from pydantic import SecretStr
+
+    stream, tools = mode in ("stream", "stream_tools"), [BenchEcho()] if mode in ("tools", "stream_tools") else None
+
+    def session():
+        ss = ModelSessionFactory.buildChatGPTSession(api_url=url, auth={'api_key': SecretStr('sk-local')})
+        # the mock server answers stream_options like api.openai.com
+        ss.stream_usage = True
+        ss.messages = [CommonMessage(role='user' if i%2==0 else 'assistant', content=SAMPLE_TEXT, content_tokens=80)
+                       for i in range(history)]
+        return ss
+
+    per_worker = max(1, requests // concurrency)
+    def worker(i):
+        # one session per worker, its history grows from `history` as it goes
+        ss, latencies, errors = session(), [], 0
+        for j in range(per_worker):
+            start = time.perf_counter()
+            try:
+                for _ in ss(f'request {i}.{j}', tools=tools, stream=stream):
+                    pass
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        return latencies, errors
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        done = list(pool.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - start
+    traced = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+
+    latencies = sorted(l for ls, _ in done for l in ls)
+    result = dict(mode=mode, history=history, concurrency=concurrency, requests=per_worker * concurrency,
+                  errors=sum(e for _, e in done), elapsed_s=elapsed, throughput_rps=len(latencies) / elapsed,
+                  latency_ms=dict(p50=_percentile(latencies, 0.5) * 1e3, p99=_percentile(latencies, 0.99) * 1e3,
+                                  mean=sum(latencies) / len(latencies) * 1e3 if latencies else 0.0,
+                                  max=latencies[-1] * 1e3 if latencies else 0.0),
+                  rss_peak_mib=_rss_peak_mib())
+    if trace_memory:
+        result['traced_peak_mib'] = traced / 2**20
+    return result
+
+
+def bench_suite(modes=("plain", "stream", "tools"), history=(0, 100, 1000), concurrency=(1, 8, 32),
+                requests: int = 64, latency: float = 0.02, chunk_delay: float = 0.001, chunk_words: int = 1,
+                reply_words: int = 50, trace_memory: bool = False, output: str = None):
+    """ChatGPTSession against the local mock server, every mode x history length x concurrency.
+
+    Reports throughput, p50/p99 latency and memory as JSON, to `output` or stdout.
+    rss_peak_mib is the process peak so far; trace_memory adds the python heap peak
+    of each case (tracemalloc, slows the case down).
+    modes: plain, stream, tools (one function call, then the reply), stream_tools
+    """
+    import platform
+    import orjson
+    from mockserver import MockChatServer
+
+    modes, history, concurrency = [tuple(v) if isinstance(v, (list, tuple)) else (v,) for v in (modes, history, concurrency)]
+    for mode in modes:
+        if mode not in SUITE_MODES:
+            raise ValueError(f"unknown mode {mode}, expected one of {SUITE_MODES}")
+    reply = " ".join(f"w{i}" for i in range(reply_words))
+    results = []
+    with MockChatServer(reply=reply, latency=latency, chunk_delay=chunk_delay, chunk_words=chunk_words,
+                        keep_requests=False) as server:
+        for mode in modes:
+            for h in history:
+                for c in concurrency:
+                    case = _suite_case(server.url, mode, h, c, requests, trace_memory)
+                    results.append(case)
+                    print(f"{mode:12s} history {h:>6,} x{c:<3} {case['throughput_rps']:8,.1f} req/s  "
+                          f"p50 {case['latency_ms']['p50']:8,.1f} ms  p99 {case['latency_ms']['p99']:8,.1f} ms  "
+                          f"errors {case['errors']}", file=sys.stderr)
+
+    report = dict(meta=dict(python=platform.python_version(), platform=platform.platform(), time=time.time(),
+                            latency=latency, chunk_delay=chunk_delay, chunk_words=chunk_words,
+                            reply_words=reply_words, requests=requests),
+                  results=results)
+    data = orjson.dumps(report, option=orjson.OPT_INDENT_2)
+    if output:
+        with open(output, 'wb') as f:
+            f.write(data)
+    else:
+        print(data.decode())
+
+
+# optional subsystems that must load on first use, never on import
+HEAVY_MODULES = ("selenium", "webdriver_manager", "bs4", "lxml", "selectolax", "tiktoken", "openai", "numpy")
+
+
+def _import_profile(module: str) -> Dict[str, Tuple[int, int]]:
+    """{module: (self us, cumulative us)} from a fresh interpreter's -X importtime."""
+    import os, subprocess
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stderr
+    profile = {}
+    for line in out.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        profile[parts[2].strip()] = (int(parts[0].split(":")[1]), int(parts[1]))
+    return profile
+
+
+def bench_import(modules=("simpleaichat", "chatgpt", "tools"), runs: int = 5, budget_ms: float = 500, top: int = 5,
+                 output: str = None):
+    """import time of each module in a fresh interpreter (-X importtime, median of `runs`).
+
+    Fails (exit 1) when a module takes longer than budget_ms or pulls in one of HEAVY_MODULES.
+    """
+    import statistics
+    import orjson
+
+    modules = tuple(modules) if isinstance(modules, (list, tuple)) else (modules,)
+    results, failed = [], False
+    for module in modules:
+        profiles = [_import_profile(module) for _ in range(runs)]
+        total = statistics.median(p[module][1] for p in profiles) / 1e3
+        heavy = sorted({name for name in profiles[0] if name.split(".")[0] in HEAVY_MODULES})
+        slowest = sorted(profiles[0].items(), key=lambda kv: kv[1][0], reverse=True)[:top]
+        ok = total <= budget_ms and not heavy
+        failed |= not ok
+        results.append(dict(module=module, import_ms=total, budget_ms=budget_ms, ok=ok, heavy=heavy,
+                            slowest=[dict(module=name, self_ms=t[0] / 1e3) for name, t in slowest]))
+        print(f"import {module}: {total:,.1f} ms (budget {budget_ms:,.0f} ms) {'ok' if ok else 'OVER'}"
+              + (f", loads {', '.join(heavy)}" if heavy else ""), file=sys.stderr)
+        for name, t in slowest:
+            print(f"  {name:40s} {t[0]/1e3:7,.1f} ms self", file=sys.stderr)
+    if output:
+        with open(output, 'wb') as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire()
@@ -0,0 +1,245 @@
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from sys import platform
+from typing import Callable, Dict, Iterator, List, Optional, Type
+
+from selenium.common.exceptions import (JavascriptException, NoSuchElementException, StaleElementReferenceException,
+                                        TimeoutException, WebDriverException)
+from selenium.webdriver.chrome.options import Options as ChromeOptions
+from selenium.webdriver.chrome.service import Service as ChromeDriverService
+from selenium.webdriver.chrome.webdriver import WebDriver as ChromeDriver
+from selenium.webdriver.common.by import By
+from selenium.webdriver.common.options import ArgOptions as BrowserOptions
+from selenium.webdriver.edge.options import Options as EdgeOptions
+from selenium.webdriver.edge.service import Service as EdgeDriverService
+from selenium.webdriver.edge.webdriver import WebDriver as EdgeDriver
+from selenium.webdriver.firefox.options import Options as FirefoxOptions
+from selenium.webdriver.firefox.service import Service as GeckoDriverService
+from selenium.webdriver.firefox.webdriver import WebDriver as FirefoxDriver
+from selenium.webdriver.remote.webdriver import WebDriver
+from selenium.webdriver.safari.options import Options as SafariOptions
+from selenium.webdriver.safari.webdriver import WebDriver as SafariDriver
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.wait import WebDriverWait
+
+from utils import USER_AGENT
+
+# driver binaries, resolved (and downloaded by webdriver_manager if needed) once per browser
+_DRIVER_PATHS: Dict[str, Optional[str]] = {}
+_DRIVER_PATHS_LOCK = threading.Lock()
+# WebDriverException subclasses raised by a slow or odd page, the browser itself is still fine
+PAGE_ERRORS = (TimeoutException, NoSuchElementException, StaleElementReferenceException, JavascriptException)
+
+
+def resolve_driver_path(browser: str = "chrome") -> Optional[str]:
+    try:
+        return _DRIVER_PATHS[browser]
+    except KeyError:
+        pass
+    with _DRIVER_PATHS_LOCK:
+        if browser not in _DRIVER_PATHS:
+            if browser == "firefox":
+                from webdriver_manager.firefox import GeckoDriverManager
+                path = GeckoDriverManager().install()
+            elif browser == "edge":
+                from webdriver_manager.microsoft import EdgeChromiumDriverManager
+                path = EdgeChromiumDriverManager().install()
+            elif browser == "safari":
+                # safaridriver ships with the OS
+                path = None
+            else:
+                chromium_driver_path = Path("/usr/bin/chromedriver")
+                if chromium_driver_path.exists():
+                    path = str(chromium_driver_path)
+                else:
+                    from webdriver_manager.chrome import ChromeDriverManager
+                    path = ChromeDriverManager().install()
+            _DRIVER_PATHS[browser] = path
+        return _DRIVER_PATHS[browser]
+
+
+def new_driver(browser: str = "chrome", headless: bool = True, debugging_port: Optional[int] = None) -> WebDriver:
+    """Start a browser. Pass debugging_port=9222 for the old single-browser setup,
+    a fixed port can't be shared by several chrome instances."""
+    options_available: Dict[str, Type[BrowserOptions]] = {
+        "chrome": ChromeOptions,
+        "edge": EdgeOptions,
+        "firefox": FirefoxOptions,
+        "safari": SafariOptions,
+    }
+    options: BrowserOptions = options_available[browser]()
+    options.add_argument(f"user-agent={USER_AGENT}")
+
+    if browser == "firefox":
+        if headless:
+            options.add_argument("-headless")
+            options.add_argument("--disable-gpu")
+        return FirefoxDriver(service=GeckoDriverService(resolve_driver_path(browser)), options=options)
+    if browser == "edge":
+        return EdgeDriver(service=EdgeDriverService(resolve_driver_path(browser)), options=options)
+    if browser == "safari":
+        # Requires a bit more setup on the users end
+        # See https://developer.apple.com/documentation/webkit/testing_with_webdriver_in_safari
+        return SafariDriver(options=options)
+
+    if platform == "linux" or platform == "linux2":
+        options.add_argument("--disable-dev-shm-usage")
+        if debugging_port is not None:
+            options.add_argument(f"--remote-debugging-port={debugging_port}")
+    options.add_argument("--no-sandbox")
+    if headless:
+        options.add_argument("--headless=new")
+        options.add_argument("--disable-gpu")
+    return ChromeDriver(service=ChromeDriverService(resolve_driver_path(browser)), options=options)
+
+
+class _PooledDriver:
+    __slots__ = ("driver", "pages")
+
+    def __init__(self, driver: WebDriver):
+        self.driver = driver
+        self.pages = 0
+
+
+class BrowserPool:
+    """Keeps up to `size` headless browsers warm between page loads.
+
+    borrow() hands a driver to one caller at a time and blocks while all of
+    them are busy. A driver is quit and replaced after `max_pages` pages or
+    when it raises a WebDriverException other than the page errors in
+    PAGE_ERRORS (a page load timeout goes back to the pool).
+    """
+
+    def __init__(self, size: int = 2, browser: str = "chrome", headless: bool = True, max_pages: int = 50,
+                 page_timeout: float = 10, factory: Optional[Callable[[], WebDriver]] = None):
+        self.size = size
+        self.browser = browser
+        self.headless = headless
+        self.max_pages = max_pages
+        self.page_timeout = page_timeout
+        self.factory = factory if factory is not None else (lambda: new_driver(browser, headless))
+        self._idle: List[_PooledDriver] = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.started = 0
+        self.recycled = 0
+        self.crashed = 0
+        self.pages = 0
+
+    def warmup(self, n: Optional[int] = None):
+        # start browsers ahead of the first tool call
+        n = self.size if n is None else min(n, self.size)
+        with self._lock:
+            missing = n - len(self._idle)
+        for _ in range(max(0, missing)):
+            self._slots.acquire()
+            try:
+                pooled = self._start()
+            finally:
+                self._slots.release()
+            with self._lock:
+                self._idle.append(pooled)
+
+    def _start(self) -> _PooledDriver:
+        pooled = _PooledDriver(self.factory())
+        with self._lock:
+            self.started += 1
+        return pooled
+
+    @staticmethod
+    def _quit(pooled: _PooledDriver):
+        try:
+            pooled.driver.quit()
+        except Exception:
+            pass
+
+    @contextmanager
+    def borrow(self, timeout: Optional[float] = None) -> Iterator[WebDriver]:
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("no browser available")
+        try:
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("browser pool is closed")
+                pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                pooled = self._start()
+            try:
+                yield pooled.driver
+            except PAGE_ERRORS:
+                self._release(pooled)
+                raise
+            except WebDriverException:
+                # the browser may be gone, never hand it out again
+                with self._lock:
+                    self.crashed += 1
+                self._quit(pooled)
+                raise
+            except BaseException:
+                self._release(pooled)
+                raise
+            else:
+                self._release(pooled)
+        finally:
+            self._slots.release()
+
+    def _release(self, pooled: _PooledDriver):
+        pooled.pages += 1
+        with self._lock:
+            self.pages += 1
+            keep = not self._closed and pooled.pages < self.max_pages
+            if keep:
+                self._idle.append(pooled)
+            else:
+                self.recycled += 1
+        if not keep:
+            self._quit(pooled)
+
+    def fetch(self, url: str, timeout: Optional[float] = None) -> str:
+        """Load url in a pooled browser and return document.body.outerHTML."""
+        with self.borrow(timeout) as driver:
+            driver.get(url)
+            WebDriverWait(driver, self.page_timeout).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+            return driver.execute_script("return document.body.outerHTML;")
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self._quit(pooled)
+
+    def stats(self):
+        with self._lock:
+            return dict(size=self.size, idle=len(self._idle), started=self.started, recycled=self.recycled,
+                        crashed=self.crashed, pages=self.pages)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# shared by every BrowseLink that wasn't given its own pool
+_default_pool: Optional[BrowserPool] = None
+_default_pool_lock = threading.Lock()
+
+
+def get_browser_pool() -> BrowserPool:
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = BrowserPool()
+    return _default_pool
+
+
+def set_browser_pool(pool: Optional[BrowserPool]):
+    global _default_pool
+    with _default_pool_lock:
+        old, _default_pool = _default_pool, pool
+    if old is not None and old is not pool:
+        old.close()
@@ -0,0 +1,148 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import orjson
+
+
+class CompletionCache:
+    """Base for completion caches keyed on the normalized request payload.
+
+    Only deterministic requests (temperature 0, a single choice) are cached
+    unless deterministic_only=False.
+    """
+
+    def __init__(self, ttl: Optional[float] = None, maxsize: Optional[int] = 1024, deterministic_only: bool = True):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.deterministic_only = deterministic_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(payload: Dict[str, Any]) -> str:
+        # stream only changes the framing of the same completion
+        normalized = {k: v for k, v in payload.items() if k != "stream"}
+        return hashlib.sha256(orjson.dumps(normalized, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    def accepts(self, payload: Dict[str, Any]) -> bool:
+        if not self.deterministic_only:
+            return True
+        return not payload.get("temperature") and (payload.get("n") or 1) == 1
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self._get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]):
+        self._set(key, value)
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def _set(self, key: str, value: Dict[str, Any]):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / total if total else 0.0, size=len(self))
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class LRUCache(CompletionCache):
+    """In-memory LRU with optional TTL."""
+
+    def __init__(self, ttl: Optional[float] = None, maxsize: Optional[int] = 1024, deterministic_only: bool = True):
+        super().__init__(ttl, maxsize, deterministic_only)
+        self._data: "OrderedDict[str, Any]" = OrderedDict()
+
+    def _get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            created, value = item
+            if self.ttl is not None and time.monotonic() - created > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def _set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while self.maxsize is not None and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache(CompletionCache):
+    """On-disk cache in a single SQLite file, evicts the least recently used rows past maxsize.
+    Eviction runs every `evict_every` writes, so the table may briefly exceed maxsize."""
+
+    evict_every = 64
+
+    def __init__(self, path: str = "completion_cache.sqlite", ttl: Optional[float] = None,
+                 maxsize: Optional[int] = 100_000, deterministic_only: bool = True):
+        super().__init__(ttl, maxsize, deterministic_only)
+        self.path = path
+        self._writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS completions "
+                         "(key TEXT PRIMARY KEY, value BLOB, created REAL, accessed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM completions WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM completions WHERE key=?", (key,))
+                return None
+            self._db.execute("UPDATE completions SET accessed=? WHERE key=?", (now, key))
+        return orjson.loads(row[0])
+
+    def _set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                             (key, orjson.dumps(value), now, now))
+            self._writes += 1
+            if self.maxsize is not None and self._writes % self.evict_every == 0:
+                self._db.execute("DELETE FROM completions WHERE key IN (SELECT key FROM completions "
+                                 "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.maxsize,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM completions")
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
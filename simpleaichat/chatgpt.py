@@ -2,13 +2,52 @@ from pydantic import BaseModel, SecretStr, HttpUrl, Field
 from typing import List, Dict, Union, Set, Any
 import os
 from uuid import uuid4, UUID
-import openai
 from tools import * 
-from models import CommonMessage, CommonChatSession, Function
-from utils import remove_a_key
+from models import CommonMessage, CommonChatSession, Function, MESSAGE_TOKEN_OVERHEAD, WIRE_FIELDS
+from utils import remove_a_key, get_token_encoder
+from transport import ChatTransport, get_default_transport
+from ratelimit import RateLimiter, get_rate_limiter
+from cache import CompletionCache
+from tooloutput import ToolOutputPolicy
+from instrument import Instrumentation
+from events import TextDelta, FunctionCallStart, ArgumentsDelta, ToolResult, Done, coalesce, acoalesce
+import httpx
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import json
+import logging
+import re
+from collections import OrderedDict
+from urllib.parse import urlsplit
 from typing import List, Dict, Union, Optional, Set, Any
-import tiktoken
+
+# max context length (prompt + completion) per model, dated snapshots (-0613, -2024-05-13)
+# fall back to their base name
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-3.5-turbo-1106': 16385,
+    'gpt-3.5-turbo-0125': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-1106-preview': 128000,
+    'gpt-4-0125-preview': 128000,
+    'gpt-4-turbo-preview': 128000,
+    'gpt-4-vision-preview': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+}
+# used for models not in the table, set context_window on the session for those
+DEFAULT_CONTEXT_WINDOW = 4096
+_MODEL_DATE = re.compile(r'-(\d{4}|\d{4}-\d{2}-\d{2})$')
+# models already warned about
+_UNKNOWN_MODELS: Set[str] = set()
+
+# shared by all sessions for concurrent tool calls
+_TOOL_POOL = ThreadPoolExecutor(max_workers=32,thread_name_prefix='simpleaichat-tool')
 
 class PromptFactory:
     @staticmethod
@@ -40,10 +79,27 @@ Answer:
 
 
 
+def _add_usage(total,usage):
+    # sums the usage records of the requests behind one reply
+    if usage is None:return total
+    if total is None:return dict(usage)
+    return {k:total.get(k,0)+usage.get(k,0) for k in set(total)|set(usage)
+            if isinstance(total.get(k,0),int) and isinstance(usage.get(k,0),int)}
+
+
+class AgentStep(BaseModel):
+    step: int
+    latency: float = 0.0
+    tool_latency: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    tools: List[str] = []
+
+
 class ChatGPTSession(CommonChatSession):    
     ################ openai config
     temperature : Optional[float] = 0.7
-    n: Optional[float] = 1
+    n: Optional[int] = 1
     max_tokens: Optional[int] = 1024
     top_p: Optional[int] = 1
     presence_penalty : Optional[float] = 0.0
@@ -64,36 +120,126 @@ class ChatGPTSession(CommonChatSession):
     # total_completion_length: int = 0
     # total_length: int = 0
     title: Optional[str] = None
+    # fill the context window by tokens (newest first) instead of slicing by recent_messages
+    token_window: bool = False
+    context_window: Optional[int] = None
+    # use the tools api, which lets the model request several calls per turn; they run concurrently
+    parallel_tool_calls: bool = False
+    tool_timeout: Optional[float] = None
+    # ask for the final usage chunk of a stream; None only asks api.openai.com, other
+    # OpenAI-compatible servers may reject stream_options, set True for those that take it
+    stream_usage: Optional[bool] = None
 
     ############################# internal ##############################    
     _params: Dict[str, Any] = dict(temperature =temperature ,top_p=top_p,n=n,max_tokens=max_tokens,presence_penalty=presence_penalty,frequency_penalty=frequency_penalty)
     _last_prompt:str = None
     _last_receive:str = None
+    # None uses the process-wide default transport
+    _transport: Optional[ChatTransport] = None
+    # None uses the process-wide limiter from ratelimit.set_rate_limiter, if any
+    _rate_limiter: Optional[RateLimiter] = None
+    # opt-in, see cache.LRUCache / cache.SQLiteCache
+    _completion_cache: Optional[CompletionCache] = None
+    _semantic_cache: Any = None
+    _agent_steps: List[AgentStep] = []
+    # None adds tool results to the history as they are
+    _tool_output_policy: Optional[ToolOutputPolicy] = None
+    # full tool results the policy shortened, by call id, least recently stored first;
+    # bounded by the policy's keep_results / keep_chars and never persisted
+    _tool_results: "OrderedDict[str, str]" = OrderedDict()
+    _tool_results_chars: int = 0
 
     def __init__(self, *args,**kwargs):
         super(self.__class__, self).__init__(*args,**kwargs)
+        self._params = dict(temperature=self.temperature,top_p=self.top_p,n=self.n,max_tokens=self.max_tokens,
+                            presence_penalty=self.presence_penalty,frequency_penalty=self.frequency_penalty)
 
         if self.system_message is None:
             self.system_message = CommonMessage(role="system", content=f'You are a helpful {self.gpt_role}.').calc_tokens(self.get_token_encoder())
 
     def __call__(self,prompt: Union[str, Any], user_name:Optional[str]=None
                  , tools:Optional[List[Any]]=None, stream:bool=False) -> str:
-        self.add_msg({'user':prompt},user_name)
+        if tools is None and self._semantic_cache is not None:
+            # embedded before it is added, a columnar history copies the message on append
+            question = self.new_msg({'user':prompt},user_name)
+            question.embedding = self._semantic_cache.embed(question.content)
+            self.add_msg(question)
+            asked = len(self.messages)-1
+            answer = self._semantic_lookup(question)
+            if answer is not None:
+                yield answer
+                return
+        else:
+            self.add_msg({'user':prompt},user_name)
         if tools is None:
             for r in self._gen() if not stream else self._stream_gen():yield r  
+            if self._semantic_cache is not None:self._semantic_store(question,asked)
         else:
             for r in self._gen_with_tools(tools) if not stream else self._stream_gen_with_tools(tools):yield r
+
+    def set_semantic_cache(self,cache):
+        # semantic.SemanticCache, only used for calls without tools
+        self._semantic_cache = cache
+        return self
+
+    def _semantic_lookup(self,question: CommonMessage):
+        answer = self._semantic_cache.lookup(self.system_message.content,question.embedding)
+        if self._instrumentation is not None:
+            self._instrumentation.record('cache_hit' if answer is not None else 'cache_miss',1,'semantic')
+        if answer is not None:
+            self.add_msg({self.gpt_role:answer},self.gpt_name)
+        return answer
+
+    def _semantic_store(self,question: CommonMessage,asked: int):
+        # by index, a columnar history builds a new message on every read
+        if len(self.messages)-1 == asked:return
+        reply = self.messages[-1]
+        if reply.role == self.gpt_role:
+            self._semantic_cache.add(self.system_message.content,question.embedding,reply.content)
     
     def get_token_encoder(self):
-        try:
-            return tiktoken.encoding_for_model(self.model.replace('-16k',''))
-        except Exception as e:
-            return None
+        return get_token_encoder(self.model.replace('-16k',''))
         
-    def get_messages_dict(self,fields: Set[str] = {"role", "content", "name"}):
+    def get_context_window(self):
+        if self.context_window is not None:
+            return self.context_window
+        window = MODEL_CONTEXT_WINDOWS.get(self.model) or MODEL_CONTEXT_WINDOWS.get(_MODEL_DATE.sub('',self.model))
+        if window is None:
+            if self.model not in _UNKNOWN_MODELS:
+                _UNKNOWN_MODELS.add(self.model)
+                logging.getLogger("simpleaichat").warning(
+                    "unknown context window for %s, assuming %d tokens; set context_window",self.model,DEFAULT_CONTEXT_WINDOW)
+            window = DEFAULT_CONTEXT_WINDOW
+        return window
+
+    def get_recent_start(self):
+        if not self.token_window:
+            start = len(self.messages)-self.recent_messages if 0<self.recent_messages<len(self.messages) else 0
+            return self._tool_group_start(start,forward=False)
+        # reserve the completion, the pinned system message and the reply priming
+        budget = (self.get_context_window() - (self._params.get('max_tokens') or 0)
+                  - self.system_message.content_tokens - MESSAGE_TOKEN_OVERHEAD - 3)
+        return self._tool_group_start(self.recent_messages_within(budget),forward=True)
+
+    def _tool_group_start(self,start,forward):
+        # the api rejects a tool message without the assistant tool_calls message before it,
+        # a window never starts inside such a group: it skips past it (staying within the token
+        # budget) or, for a message count or when the group ends the history, takes in the call
+        n = len(self.messages)
+        if not 0<start<n or self.messages[start].role!='tool':return start
+        if forward:
+            end = start
+            while end<n and self.messages[end].role=='tool':end += 1
+            if end<n:return end
+        while start>0 and self.messages[start].role=='tool':start -= 1
+        return start
+
+    def get_messages_dict(self,fields: Set[str] = WIRE_FIELDS):
+        if fields == WIRE_FIELDS:
+            return [self.system_message.to_wire()] + self.get_wire_messages(self.get_recent_start())
         model_dump = lambda x:x.model_dump(include=fields, exclude_none=True)
         msg = [model_dump(self.system_message)]
-        msg += [model_dump(m) for m in self.messages[-self.recent_messages:] ]
+        msg += [model_dump(m) for m in self.messages[self.get_recent_start():] ]
         return msg
     
     def _process_response(self,r):
@@ -102,6 +248,14 @@ class ChatGPTSession(CommonChatSession):
             arguments = ''
             content = ''
             msg = r["choices"][0]["message"]
+            if msg.get('tool_calls'):
+                calls = []
+                for call in msg['tool_calls']:
+                    calls.append((call['id'],call['function']['name'],call['function'].get('arguments','')))
+                    yield PromptFactory.function_use(self.gpt_name,call['function']['name'])
+                    yield call['function'].get('arguments','')
+                yield calls
+                return content
             if 'function_call' in msg.keys():
                 msg = msg['function_call']
                 if 'name' in msg.keys():
@@ -137,49 +291,426 @@ class ChatGPTSession(CommonChatSession):
             raise KeyError(f"No AI generation: {r}")
         return content
 
+    @staticmethod
+    def _count_delta(state,delta):
+        if state['encoder'] is not None:
+            state['completion_tokens'] += len(state['encoder'].encode(delta))
+
+    def _stream_chunk_events(self,chunk,state):
+        if chunk.get('usage'):state['usage'] = chunk['usage']
+        choices = chunk.get('choices')
+        if not choices:return
+        if choices[0].get('finish_reason'):state['finish_reason'] = choices[0]['finish_reason']
+        msg = choices[0].get("delta") or {}
+        if msg.get('tool_calls'):
+            for call in msg['tool_calls']:
+                index = call.get('index',0)
+                acc = state['tool_calls'].setdefault(index,dict(id='',name='',arguments=''))
+                acc['id'] = call.get('id') or acc['id']
+                func = call.get('function',{})
+                if func.get('name'):
+                    acc['name'] = func['name']
+                    yield FunctionCallStart(func['name'],acc['id'],index,self.gpt_name)
+                if func.get('arguments'):
+                    acc['arguments'] += func['arguments']
+                    self._count_delta(state,func['arguments'])
+                    yield ArgumentsDelta(func['arguments'],acc['id'],index)
+        elif 'function_call' in msg.keys():
+            msg = msg['function_call']
+            if 'name' in msg.keys():
+                state['funcname'] = msg['name']
+                yield FunctionCallStart(msg['name'],gpt_name=self.gpt_name)
+            if 'arguments' in msg.keys():
+                state['arguments'] += msg['arguments']
+                self._count_delta(state,msg['arguments'])
+                yield ArgumentsDelta(msg['arguments'])
+        else:
+            delta = msg.get("content")
+            if delta:
+                state['content'].append(delta)
+                self._count_delta(state,delta)
+                yield TextDelta(delta)
+
+    def _process_stream_chunk(self,chunk,state):
+        # the plain string stream is the typed one rendered with str()
+        for e in self._stream_chunk_events(chunk,state):
+            yield e.text if type(e) is TextDelta else str(e)
+
+    def _stream_usage(self,state):
+        # the provider's final usage record when it sent one, else prefix sums + the deltas counted on the way
+        usage = state['usage']
+        if usage is None:
+            usage = state['usage'] = dict(prompt_tokens=state['prompt_tokens'],completion_tokens=state['completion_tokens'],
+                                          total_tokens=state['prompt_tokens']+state['completion_tokens'])
+        if self._instrumentation is not None:
+            elapsed = time.perf_counter()-state['started']
+            if elapsed > 0:self._instrumentation.record('tokens_per_sec',usage.get('completion_tokens',0)/elapsed,stream=True)
+        self.total_prompt_length += usage.get('prompt_tokens',0)
+        self.total_completion_length += usage.get('completion_tokens',0)
+        self.total_length += usage.get('total_tokens',0)
+        return usage
+
+    def _process_stream_end(self,state):
+        self._stream_usage(state)
+        if state['tool_calls']:
+            yield [(c['id'],c['name'],c['arguments']) for _,c in sorted(state['tool_calls'].items())]
+        elif len(state['content'])>0:
+            # already counted while streaming, no second encode of the whole reply
+            self.add_msg(CommonMessage(role=self.gpt_role,content="".join(state['content']),name=self.gpt_name,
+                                       content_tokens=state['completion_tokens'],finish_reason=state['finish_reason']))
+            # yield  "".join(content)
+        else:
+            yield state['funcname'],state['arguments']
+
+    def _new_stream_state(self):
+        return dict(funcname='',arguments='',content=[],tool_calls={},usage=None,finish_reason=None,
+                    encoder=self.get_token_encoder(),prompt_tokens=self.estimate_prompt_tokens(),completion_tokens=0,
+                    started=time.perf_counter())
+
     def _process_stream_response(self,r):
+        state = self._new_stream_state()
         try:
-            funcname = ''
-            arguments = ''
-            content = []
             for chunk in r:
-                msg = chunk["choices"][0]["delta"]
-                if 'function_call' in msg.keys():
-                    msg = msg['function_call']
-                    if 'name' in msg.keys():
-                        funcname = msg['name']
-                        for r in PromptFactory.function_use(self.gpt_name,msg['name']).split(' '):yield r+' '
-                    if 'arguments' in msg.keys():
-                        arguments += msg['arguments']
-                        yield msg['arguments']
-                else:
-                    delta = msg.get("content")
-                    if delta:
-                        content.append(delta)
-                        yield content[-1]#{"delta": delta, "response": "".join(content)}
-            if len(content)>0:
-                self.add_msg({self.gpt_role:"".join(content)},self.gpt_name)
-                # yield  "".join(content)
-            else:
-                yield funcname,arguments
+                for d in self._process_stream_chunk(chunk,state):yield d
+            for d in self._process_stream_end(state):yield d
         except KeyError:
             raise KeyError(f"No AI generation: {r}")
-        
+
+    async def _aprocess_stream_response(self,r):
+        state = self._new_stream_state()
+        try:
+            async for chunk in r:
+                for d in self._process_stream_chunk(chunk,state):yield d
+            for d in self._process_stream_end(state):yield d
+        except KeyError:
+            raise KeyError(f"No AI generation: {r}")
+
+    def openai_chat_completion_payload(self,stream=False,tools_description=None):
+        payload = dict(model=self.model,**self._params,stream=stream,messages=self.get_messages_dict())
+        if stream and (self.stream_usage if self.stream_usage is not None else urlsplit(str(self.api_url)).hostname == 'api.openai.com'):
+            payload['stream_options'] = {'include_usage':True}
+        if tools_description is not None and self.parallel_tool_calls:
+            payload.update(tools=[{'type':'function','function':d} for d in tools_description],tool_choice="auto")
+        elif tools_description is not None:
+            payload.update(functions=tools_description,function_call="auto")
+        return payload
+
+    def get_transport(self) -> ChatTransport:
+        return self._transport if self._transport is not None else get_default_transport()
+
+    def set_transport(self,transport: ChatTransport):
+        self._transport = transport
+        return self
+
+    def get_rate_limiter(self) -> Optional[RateLimiter]:
+        return self._rate_limiter if self._rate_limiter is not None else get_rate_limiter()
+
+    def set_rate_limiter(self,limiter: RateLimiter):
+        self._rate_limiter = limiter
+        return self
+
+    def estimate_prompt_tokens(self):
+        # window tokens from the running prefix sum, no encoding
+        start = self.get_recent_start()
+        prefix = self._sync_token_prefix(start)
+        return prefix[-1] - prefix[start] + self.system_message.content_tokens + MESSAGE_TOKEN_OVERHEAD
+
+    def estimate_request_tokens(self):
+        # plus the completion we may get back
+        return self.estimate_prompt_tokens() + (self._params.get('max_tokens') or 0)
+
+    def get_completion_cache(self) -> Optional[CompletionCache]:
+        return self._completion_cache
+
+    def set_completion_cache(self,cache: Optional[CompletionCache]):
+        self._completion_cache = cache
+        return self
+
+    def _cache_key(self,payload,stream):
+        # streamed replies are never cached, they are consumed chunk by chunk
+        cache = self._completion_cache
+        if stream or cache is None or not cache.accepts(payload):return None
+        return cache.key(payload)
+
+    def _post(self,payload,stream=False,timeout=None):
+        api_key = self.auth['api_key'].get_secret_value()
+        transport = self.get_transport()
+        limiter = self.get_rate_limiter()
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire(self.estimate_request_tokens())
+            try:
+                if stream:
+                    return transport.stream(str(self.api_url),api_key,payload,timeout=timeout)
+                return transport.post(str(self.api_url),api_key,payload,timeout=timeout)
+            except httpx.HTTPStatusError as e:
+                if limiter is None or limiter.retry_delay(e,attempt) is None:raise
+                attempt += 1
+
+    async def _apost(self,payload,stream=False,timeout=None):
+        api_key = self.auth['api_key'].get_secret_value()
+        transport = self.get_transport()
+        limiter = self.get_rate_limiter()
+        attempt = 0
+        while True:
+            if limiter is not None:
+                await limiter.aacquire(self.estimate_request_tokens())
+            try:
+                if stream:
+                    return await transport.astream(str(self.api_url),api_key,payload,timeout=timeout)
+                return await transport.apost(str(self.api_url),api_key,payload,timeout=timeout)
+            except httpx.HTTPStatusError as e:
+                if limiter is None or limiter.retry_delay(e,attempt) is None:raise
+                attempt += 1
+
     def openai_chat_completion_create(self,stream=False,tools_description=None,timeout=None):
-        openai.api_key = self.auth['api_key'].get_secret_value()
-        if tools_description is None:
-            return openai.ChatCompletion.create(model=self.model,
-                                                **self._params,stream=stream,
-                                                messages=self.get_messages_dict(),
-                                                timeout=timeout)
-        else:
-            return openai.ChatCompletion.create(model=self.model,
-                                                **self._params,stream=stream,
-                                                messages=self.get_messages_dict(),
-                                                functions=tools_description,
-                                                function_call="auto",
-                                                timeout=timeout)
+        if self._instrumentation is not None:
+            return self._instrumented_create(stream,tools_description,timeout)
+        payload = self.openai_chat_completion_payload(stream,tools_description)
+        key = self._cache_key(payload,stream)
+        if key is not None:
+            response = self._completion_cache.get(key)
+            if response is not None:return response
+        response = self._post(payload,stream,timeout)
+        if key is not None:
+            self._completion_cache.set(key,response)
+        return response
+
+    async def aopenai_chat_completion_create(self,stream=False,tools_description=None,timeout=None):
+        if self._instrumentation is not None:
+            return await self._ainstrumented_create(stream,tools_description,timeout)
+        payload = self.openai_chat_completion_payload(stream,tools_description)
+        key = self._cache_key(payload,stream)
+        if key is not None:
+            response = self._completion_cache.get(key)
+            if response is not None:return response
+        response = await self._apost(payload,stream,timeout)
+        if key is not None:
+            self._completion_cache.set(key,response)
+        return response
+
+    ############################# instrumentation ##############################
+
+    def get_instrumentation(self) -> Optional[Instrumentation]:
+        return self._instrumentation
+
+    def set_instrumentation(self,instrumentation: Optional[Instrumentation]):
+        # e.g. instrument.HistogramRegistry(), None turns recording off
+        self._instrumentation = instrumentation
+        return self
+
+    def _instrumented_payload(self,stream,tools_description):
+        inst,started = self._instrumentation,time.perf_counter()
+        payload = self.openai_chat_completion_payload(stream,tools_description)
+        inst.record('payload',time.perf_counter()-started,messages=len(payload['messages']))
+        key = self._cache_key(payload,stream)
+        response = None
+        if key is not None:
+            response = self._completion_cache.get(key)
+            inst.record('cache_hit' if response is not None else 'cache_miss',1,'completion')
+        return started,payload,key,response
+
+    def _instrumented_response(self,started,stream,response):
+        inst,now = self._instrumentation,time.perf_counter()
+        inst.record('network',now-started,stream=stream)
+        usage = None if stream else response.get('usage')
+        if usage and now > started:
+            inst.record('tokens_per_sec',usage.get('completion_tokens',0)/(now-started))
+
+    def _instrumented_create(self,stream,tools_description,timeout):
+        started,payload,key,response = self._instrumented_payload(stream,tools_description)
+        if response is not None:return response
+        response = self._post(payload,stream,timeout)
+        self._instrumented_response(started,stream,response)
+        if key is not None:
+            self._completion_cache.set(key,response)
+        return self._observe_stream(response,started) if stream else response
+
+    async def _ainstrumented_create(self,stream,tools_description,timeout):
+        started,payload,key,response = self._instrumented_payload(stream,tools_description)
+        if response is not None:return response
+        response = await self._apost(payload,stream,timeout)
+        self._instrumented_response(started,stream,response)
+        if key is not None:
+            self._completion_cache.set(key,response)
+        return self._aobserve_stream(response,started) if stream else response
+
+    def _observe_stream(self,chunks,started):
+        inst,last = self._instrumentation,None
+        for chunk in chunks:
+            now = time.perf_counter()
+            if last is None:inst.record('ttft',now-started)
+            else:inst.record('chunk_gap',now-last)
+            last = now
+            yield chunk
+
+    async def _aobserve_stream(self,chunks,started):
+        inst,last = self._instrumentation,None
+        async for chunk in chunks:
+            now = time.perf_counter()
+            if last is None:inst.record('ttft',now-started)
+            else:inst.record('chunk_gap',now-last)
+            last = now
+            yield chunk
+
+    def _record_tool(self,funcname,started,hit):
+        inst = self._instrumentation
+        if inst is None:return
+        if hit is not None:inst.record('cache_hit' if hit else 'cache_miss',1,funcname)
+        inst.record('tool',time.perf_counter()-started,funcname,cached=bool(hit))
+
+    def _tools_prompt(self,tools: List[Any]):
+        return {t.get_class_name():(t,t.get_openai_fragment()) for t in tools}
+
+    def _call_tool(self,tools_prompt,funcname,arguments):
+        # None when the model asked for an unknown function
+        func = tools_prompt.get(funcname,(None,None))[0]
+        if func is None:return None
+        args = json.loads(arguments)
+        started = time.perf_counter()
+        key,res = func.cache_get(args)
+        hit = None if key is None else res is not None
+        if res is None:
+            res = func(**args)
+            func.cache_set(key,res)
+        self._record_tool(funcname,started,hit)
+        return args,res
+
+    async def _acall_tool(self,tools_prompt,funcname,arguments,executor=None):
+        func = tools_prompt.get(funcname,(None,None))[0]
+        if func is None:return None
+        args = json.loads(arguments)
+        # cache hits are answered on the loop, blocking tools run in the executor
+        started = time.perf_counter()
+        key,res = func.cache_get(args)
+        hit = None if key is None else res is not None
+        if res is None:
+            if hasattr(func,'acall'):
+                # tools with native async io run on the loop
+                res = await func.acall(**args)
+            else:
+                res = await asyncio.get_running_loop().run_in_executor(executor,functools.partial(func,**args))
+            func.cache_set(key,res)
+        self._record_tool(funcname,started,hit)
+        return args,res
+
+    def get_tool_output_policy(self) -> Optional[ToolOutputPolicy]:
+        return self._tool_output_policy
+
+    def set_tool_output_policy(self,policy: Optional[ToolOutputPolicy]):
+        self._tool_output_policy = policy
+        return self
+
+    def get_tool_result(self,ref: str) -> Optional[str]:
+        # the full output of a tool call whose history message was shortened, None once it was dropped
+        return self._tool_results.get(ref)
+
+    def _keep_tool_result(self,ref,text):
+        policy,results = self._tool_output_policy,self._tool_results
+        old = results.pop(ref,None)
+        if old is not None:self._tool_results_chars -= len(old)
+        results[ref] = text
+        self._tool_results_chars += len(text)
+        # a result bigger than keep_chars on its own isn't kept either
+        while results and ((policy.keep_results is not None and len(results) > policy.keep_results) or
+                           (policy.keep_chars is not None and self._tool_results_chars > policy.keep_chars)):
+            self._tool_results_chars -= len(results.popitem(last=False)[1])
 
+    def _summary_payload(self,text,prompt):
+        return dict(model=self.model,**self._params,stream=False,
+                    messages=[{'role':'system','content':prompt},{'role':'user','content':text}])
+
+    def summarize_text(self,text: str,prompt: str) -> str:
+        # one-off request, the history is left alone
+        return self._post(self._summary_payload(text,prompt))['choices'][0]['message']['content']
+
+    async def asummarize_text(self,text: str,prompt: str) -> str:
+        return (await self._apost(self._summary_payload(text,prompt)))['choices'][0]['message']['content']
+
+    def _tool_result_ref(self,funcname,call_id):
+        return call_id if call_id is not None else f'{funcname}-{uuid4().hex[:8]}'
+
+    def _shape_tool_result(self,funcname,res,call_id=None):
+        text = str(res)
+        if self._tool_output_policy is None:return text
+        ref = self._tool_result_ref(funcname,call_id)
+        content = self._tool_output_policy.apply(self,funcname,text,ref)
+        if content is not text:self._keep_tool_result(ref,text)
+        return content
+
+    async def _ashape_tool_result(self,funcname,res,call_id=None):
+        text = str(res)
+        if self._tool_output_policy is None:return text
+        ref = self._tool_result_ref(funcname,call_id)
+        content = await self._tool_output_policy.aapply(self,funcname,text,ref)
+        if content is not text:self._keep_tool_result(ref,text)
+        return content
+
+    def _add_tool_result(self,funcname,res,call_id=None,content=None):
+        # content is the already shaped result on the async paths
+        if content is None:
+            content = self._shape_tool_result(funcname,res,call_id)
+        if call_id is None:
+            self.add_msg({'function':content},funcname)
+            return
+        # the tools api matches results by tool_call_id, tool messages carry no name
+        self.add_msg(CommonMessage(role='tool',content=content,tool_call_id=call_id).calc_tokens(self.get_token_encoder()))
+
+    def _tool_timeout(self,tools_prompt,funcname):
+        func = tools_prompt.get(funcname,(None,None))[0]
+        timeout = getattr(func,'_timeout',None)
+        return timeout if timeout is not None else self.tool_timeout
+
+    def _add_tool_calls(self,calls,results,contents=None):
+        # the assistant turn that requested the calls, then one tool message per call, in request order
+        encoder = self.get_token_encoder()
+        # the calls are sent back with the history, their names and arguments count against the window
+        tokens = sum(len(encoder.encode(n))+len(encoder.encode(a or '')) for _,n,a in calls) if encoder is not None else 0
+        self.add_msg(CommonMessage(role=self.gpt_role,content='',name=self.gpt_name,content_tokens=tokens,
+                                   tool_calls=[{'id':i,'type':'function','function':{'name':n,'arguments':a}} for i,n,a in calls]))
+        for i,((call_id,funcname,arguments),(args,res)) in enumerate(zip(calls,results)):
+            self._add_tool_result(funcname,res,call_id,None if contents is None else contents[i])
+            yield PromptFactory.function_res(funcname,args if args is not None else arguments,res)
+
+    def _execute_tool_calls(self,tools_prompt,calls):
+        started = time.monotonic()
+        futures = [_TOOL_POOL.submit(self._call_tool,tools_prompt,funcname,arguments) for _,funcname,arguments in calls]
+        results = []
+        for (_,funcname,arguments),future in zip(calls,futures):
+            timeout = self._tool_timeout(tools_prompt,funcname)
+            # failures become the tool's answer so the model can react, and the other calls still report back
+            try:
+                called = future.result(None if timeout is None else max(0,started+timeout-time.monotonic()))
+                results.append(called if called is not None else (None,f'unknown function {funcname}'))
+            except (FutureTimeoutError,asyncio.TimeoutError):
+                results.append((None,f'{funcname} timed out'))
+            except Exception as e:
+                results.append((None,f'{funcname} failed: {e!r}'))
+        return results
+
+    def _run_tool_calls(self,tools_prompt,calls):
+        for r in self._add_tool_calls(calls,self._execute_tool_calls(tools_prompt,calls)):yield r
+
+    async def _aexecute_tool_calls(self,tools_prompt,calls):
+        # (results, shaped history contents)
+        async def run(funcname,arguments):
+            future = self._acall_tool(tools_prompt,funcname,arguments,_TOOL_POOL)
+            try:
+                called = await asyncio.wait_for(future,self._tool_timeout(tools_prompt,funcname))
+                return called if called is not None else (None,f'unknown function {funcname}')
+            except (FutureTimeoutError,asyncio.TimeoutError):
+                return None,f'{funcname} timed out'
+            except Exception as e:
+                return None,f'{funcname} failed: {e!r}'
+        results = await asyncio.gather(*[run(funcname,arguments) for _,funcname,arguments in calls])
+        contents = await asyncio.gather(*[self._ashape_tool_result(funcname,res,call_id)
+                                          for (call_id,funcname,_),(_,res) in zip(calls,results)])
+        return results,contents
+
+    async def _arun_tool_calls(self,tools_prompt,calls):
+        results,contents = await self._aexecute_tool_calls(tools_prompt,calls)
+        for r in self._add_tool_calls(calls,results,contents):yield r
 
     def _gen(self,timeout=None):        
         response = self.openai_chat_completion_create(stream=False,timeout=timeout)
@@ -188,66 +719,296 @@ class ChatGPTSession(CommonChatSession):
     
     
     def _gen_with_tools(self,tools: List[Any],):
-        tools_prompt = {t.get_class_name():(t,t.get_openai_description()) for t in tools}
+        tools_prompt = self._tools_prompt(tools)
         self._last_receive = response = self.openai_chat_completion_create(stream=False,
                                                       tools_description=[t[1] for t in tools_prompt.values()])
         for r in  self._process_response(response):
             if type(r) is tuple and len(r)==2:
                 funcname,arguments = r
-                func = tools_prompt.get(funcname,(None,None))[0]
-                args = json.loads(arguments)
-                if func is not None:
-                    res = func(**args)
+                called = self._call_tool(tools_prompt,funcname,arguments)
+                if called is not None:
+                    args,res = called
                     yield PromptFactory.function_res(funcname,args,res)
-                    self.add_msg({'function':str(res)},funcname)
+                    self._add_tool_result(funcname,res)
                     for r in self._gen() :yield r
+            elif type(r) is list:
+                for r in self._run_tool_calls(tools_prompt,r):yield r
+                for r in self._gen() :yield r
             else:
                 yield r
 
     def _stream_gen(self,timeout=None):
         response = self.openai_chat_completion_create(stream=True,timeout=timeout)
-        for r in self._process_stream_response(response):
+        r = None
+        try:
+            for r in self._process_stream_response(response):
+                if type(r) is tuple and len(r)==2 or type(r) is list:continue
+                yield r
+        finally:
+            # once per reply, not per chunk
             self._last_receive = r
-            if type(r) is tuple and len(r)==2:continue
-            yield r
 
     def _stream_gen_with_tools(self,tools: List[Any],):
-        tools_prompt = {t.get_class_name():(t,t.get_openai_description()) for t in tools}
+        tools_prompt = self._tools_prompt(tools)
         response = self.openai_chat_completion_create(stream=True,
                                                       tools_description=[t[1] for t in tools_prompt.values()])
-        for r in self._process_stream_response(response):            
-            self._last_receive = r
+        for r in self._process_stream_response(response):
             if type(r) is tuple and len(r)==2:
+                self._last_receive = r
                 funcname,arguments = r
-                func = tools_prompt.get(funcname,(None,None))[0]
-                args = json.loads(arguments)
-                if func is not None:
-                    res = func(**args)
-                    for r in PromptFactory.function_res(funcname,args,res).split(' '):yield r+' '
-                    self.add_msg({'function':str(res)},funcname)
+                called = self._call_tool(tools_prompt,funcname,arguments)
+                if called is not None:
+                    args,res = called
+                    yield PromptFactory.function_res(funcname,args,res)
+                    self._add_tool_result(funcname,res)
                     for r in self._stream_gen() :yield r
+            elif type(r) is list:
+                self._last_receive = r
+                for r in self._run_tool_calls(tools_prompt,r):yield r
+                for r in self._stream_gen() :yield r
+            else:
+                yield r
+
+    ############################# typed events ##############################
+
+    def stream_events(self,prompt: Union[str, Any], user_name:Optional[str]=None, tools:Optional[List[Any]]=None,
+                      max_chars:Optional[int]=1024, max_delay:Optional[float]=0.05):
+        """Stream the reply as events.TextDelta / FunctionCallStart / ArgumentsDelta / ToolResult,
+        ending with one events.Done carrying the usage. Consecutive deltas are merged up to
+        max_chars characters or max_delay seconds, max_chars=None yields every delta as it arrives."""
+        self.add_msg({'user':prompt},user_name)
+        events = self._stream_events(tools)
+        return events if max_chars is None else coalesce(events,max_chars,max_delay)
+
+    def _stream_end_calls(self,state):
+        # tools api calls as a list, a legacy function call as a 1-tuple, None for a plain reply
+        pending = None
+        for pending in self._process_stream_end(state):pass
+        self._last_receive = pending
+        if type(pending) is list:return pending
+        if type(pending) is tuple and pending[0]:return [(None,)+pending]
+        return None
+
+    def _tool_result_events(self,calls,results):
+        for (call_id,funcname,arguments),(args,res) in zip(calls,results):
+            yield ToolResult(funcname,args if args is not None else arguments,res,call_id)
+
+    def _stream_events(self,tools=None):
+        tools_prompt = self._tools_prompt(tools) if tools else None
+        usage,state = None,None
+        while True:
+            response = self.openai_chat_completion_create(stream=True,
+                            tools_description=None if tools_prompt is None else [t[1] for t in tools_prompt.values()])
+            state = self._new_stream_state()
+            for chunk in response:
+                for e in self._stream_chunk_events(chunk,state):yield e
+            calls = self._stream_end_calls(state)
+            usage = _add_usage(usage,state['usage'])
+            if calls is None or tools_prompt is None:break
+            if calls[0][0] is None:
+                # legacy function_call
+                funcname,arguments = calls[0][1:]
+                results = [self._call_tool(tools_prompt,funcname,arguments) or (None,f'unknown function {funcname}')]
+                self._add_tool_result(funcname,results[0][1])
+            else:
+                results = self._execute_tool_calls(tools_prompt,calls)
+                for _ in self._add_tool_calls(calls,results):pass
+            for e in self._tool_result_events(calls,results):yield e
+            # one tool hop, like stream=True with tools
+            tools_prompt = None
+        yield Done(usage,state['finish_reason'])
+
+    async def astream_events(self,prompt: Union[str, Any], user_name:Optional[str]=None, tools:Optional[List[Any]]=None,
+                             max_chars:Optional[int]=1024, max_delay:Optional[float]=0.05):
+        self.add_msg({'user':prompt},user_name)
+        events = self._astream_events(tools)
+        if max_chars is not None:events = acoalesce(events,max_chars,max_delay)
+        async for e in events:yield e
+
+    async def _astream_events(self,tools=None):
+        tools_prompt = self._tools_prompt(tools) if tools else None
+        usage,state = None,None
+        while True:
+            response = await self.aopenai_chat_completion_create(stream=True,
+                            tools_description=None if tools_prompt is None else [t[1] for t in tools_prompt.values()])
+            state = self._new_stream_state()
+            async for chunk in response:
+                for e in self._stream_chunk_events(chunk,state):yield e
+            calls = self._stream_end_calls(state)
+            usage = _add_usage(usage,state['usage'])
+            if calls is None or tools_prompt is None:break
+            if calls[0][0] is None:
+                funcname,arguments = calls[0][1:]
+                results = [await self._acall_tool(tools_prompt,funcname,arguments) or (None,f'unknown function {funcname}')]
+                self._add_tool_result(funcname,results[0][1],None,await self._ashape_tool_result(funcname,results[0][1]))
+            else:
+                results,contents = await self._aexecute_tool_calls(tools_prompt,calls)
+                for _ in self._add_tool_calls(calls,results,contents):pass
+            for e in self._tool_result_events(calls,results):yield e
+            tools_prompt = None
+        yield Done(usage,state['finish_reason'])
+
+    ############################# agent ##############################
+
+    def get_agent_steps(self) -> List[AgentStep]:
+        return self._agent_steps
+
+    def _agent_plan(self,tools: List[Any]):
+        # tool lookup and schemas are built once per run, not per step
+        tools_prompt = self._tools_prompt(tools)
+        return tools_prompt,[t[1] for t in tools_prompt.values()]
+
+    def _agent_step_done(self,step: AgentStep,response,used: int) -> int:
+        usage = response.get('usage') or {}
+        step.prompt_tokens = usage.get('prompt_tokens',0)
+        step.completion_tokens = usage.get('completion_tokens',0)
+        self._agent_steps.append(step)
+        return used + step.prompt_tokens + step.completion_tokens
+
+    def _agent_is_last(self,n,max_steps,used,max_total_tokens):
+        return n == max_steps-1 or (max_total_tokens is not None and used >= max_total_tokens)
+
+    def agent(self,prompt: Union[str, Any], tools: List[Any], max_steps:int=8,
+              max_total_tokens:Optional[int]=None, user_name:Optional[str]=None):
+        """Let the model call tools for up to max_steps requests, then answer.
+        The last step (or the first past max_total_tokens) is sent without tools to force a reply.
+        Per-step latency and usage are in get_agent_steps()."""
+        self.add_msg({'user':prompt},user_name)
+        tools_prompt,descriptions = self._agent_plan(tools)
+        self._agent_steps = []
+        used = 0
+        for n in range(max_steps):
+            last = self._agent_is_last(n,max_steps,used,max_total_tokens)
+            step = AgentStep(step=n)
+            started = time.perf_counter()
+            self._last_receive = response = self.openai_chat_completion_create(tools_description=None if last else descriptions)
+            step.latency = time.perf_counter()-started
+            used = self._agent_step_done(step,response,used)
+            for r in self._process_response(response):
+                if type(r) is tuple and len(r)==2:
+                    r = [(None,)+r]
+                if type(r) is list:
+                    started = time.perf_counter()
+                    step.tools += [funcname for _,funcname,_ in r]
+                    if r[0][0] is None:
+                        # legacy function_call, a single call answered with a function message
+                        called = self._call_tool(tools_prompt,r[0][1],r[0][2]) or (None,f'unknown function {r[0][1]}')
+                        yield PromptFactory.function_res(r[0][1],*called)
+                        self._add_tool_result(r[0][1],called[1])
+                    else:
+                        for d in self._run_tool_calls(tools_prompt,r):yield d
+                    step.tool_latency += time.perf_counter()-started
+                else:
+                    yield r
+            if not step.tools:break
+
+    async def aagent(self,prompt: Union[str, Any], tools: List[Any], max_steps:int=8,
+                     max_total_tokens:Optional[int]=None, user_name:Optional[str]=None):
+        self.add_msg({'user':prompt},user_name)
+        tools_prompt,descriptions = self._agent_plan(tools)
+        self._agent_steps = []
+        used = 0
+        for n in range(max_steps):
+            last = self._agent_is_last(n,max_steps,used,max_total_tokens)
+            step = AgentStep(step=n)
+            started = time.perf_counter()
+            self._last_receive = response = await self.aopenai_chat_completion_create(tools_description=None if last else descriptions)
+            step.latency = time.perf_counter()-started
+            used = self._agent_step_done(step,response,used)
+            for r in self._process_response(response):
+                if type(r) is tuple and len(r)==2:
+                    r = [(None,)+r]
+                if type(r) is list:
+                    started = time.perf_counter()
+                    step.tools += [funcname for _,funcname,_ in r]
+                    if r[0][0] is None:
+                        called = await self._acall_tool(tools_prompt,r[0][1],r[0][2]) or (None,f'unknown function {r[0][1]}')
+                        yield PromptFactory.function_res(r[0][1],*called)
+                        self._add_tool_result(r[0][1],called[1],None,await self._ashape_tool_result(r[0][1],called[1]))
+                    else:
+                        async for d in self._arun_tool_calls(tools_prompt,r):yield d
+                    step.tool_latency += time.perf_counter()-started
+                else:
+                    yield r
+            if not step.tools:break
+
+    ############################# asyncio ##############################
+
+    async def acall(self,prompt: Union[str, Any], user_name:Optional[str]=None
+                    , tools:Optional[List[Any]]=None, stream:bool=False):
+        if tools is None and self._semantic_cache is not None:
+            question = self.new_msg({'user':prompt},user_name)
+            # embedding functions usually block on network
+            question.embedding = await asyncio.get_running_loop().run_in_executor(None,self._semantic_cache.embed,question.content)
+            self.add_msg(question)
+            asked = len(self.messages)-1
+            answer = self._semantic_lookup(question)
+            if answer is not None:
+                yield answer
+                return
+        else:
+            self.add_msg({'user':prompt},user_name)
+        if tools is None:
+            gen = self._agen() if not stream else self._astream_gen()
+        else:
+            gen = self._agen_with_tools(tools) if not stream else self._astream_gen_with_tools(tools)
+        async for r in gen:yield r
+        if tools is None and self._semantic_cache is not None:self._semantic_store(question,asked)
+
+    def astream(self,prompt: Union[str, Any], user_name:Optional[str]=None, tools:Optional[List[Any]]=None):
+        return self.acall(prompt,user_name,tools,stream=True)
+
+    async def _agen(self,timeout=None):
+        response = await self.aopenai_chat_completion_create(stream=False,timeout=timeout)
+        self._last_receive = response
+        for r in self._process_response(response):yield r
+
+    async def _agen_with_tools(self,tools: List[Any],):
+        tools_prompt = self._tools_prompt(tools)
+        self._last_receive = response = await self.aopenai_chat_completion_create(stream=False,
+                                                      tools_description=[t[1] for t in tools_prompt.values()])
+        for r in self._process_response(response):
+            if type(r) is tuple and len(r)==2:
+                funcname,arguments = r
+                called = await self._acall_tool(tools_prompt,funcname,arguments)
+                if called is not None:
+                    args,res = called
+                    yield PromptFactory.function_res(funcname,args,res)
+                    self._add_tool_result(funcname,res,None,await self._ashape_tool_result(funcname,res))
+                    async for r in self._agen() :yield r
+            elif type(r) is list:
+                async for r in self._arun_tool_calls(tools_prompt,r):yield r
+                async for r in self._agen() :yield r
+            else:
+                yield r
+
+    async def _astream_gen(self,timeout=None):
+        response = await self.aopenai_chat_completion_create(stream=True,timeout=timeout)
+        r = None
+        try:
+            async for r in self._aprocess_stream_response(response):
+                if type(r) is tuple and len(r)==2 or type(r) is list:continue
+                yield r
+        finally:
+            self._last_receive = r
+
+    async def _astream_gen_with_tools(self,tools: List[Any],):
+        tools_prompt = self._tools_prompt(tools)
+        response = await self.aopenai_chat_completion_create(stream=True,
+                                                      tools_description=[t[1] for t in tools_prompt.values()])
+        async for r in self._aprocess_stream_response(response):
+            if type(r) is tuple and len(r)==2:
+                self._last_receive = r
+                funcname,arguments = r
+                called = await self._acall_tool(tools_prompt,funcname,arguments)
+                if called is not None:
+                    args,res = called
+                    yield PromptFactory.function_res(funcname,args,res)
+                    self._add_tool_result(funcname,res,None,await self._ashape_tool_result(funcname,res))
+                    async for r in self._astream_gen() :yield r
+            elif type(r) is list:
+                self._last_receive = r
+                async for r in self._arun_tool_calls(tools_prompt,r):yield r
+                async for r in self._astream_gen() :yield r
             else:
                 yield r
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
-            
\ No newline at end of file
@@ -0,0 +1,110 @@
+import datetime
+from array import array
+from collections.abc import Sequence
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from models import CommonMessage
+
+# rarely set fields, kept in a sparse dict instead of a column each
+_SPARSE_FIELDS = ("function_call", "tool_calls", "tool_call_id", "finish_reason",
+                  "prompt_length", "completion_length", "total_length")
+
+
+class ColumnarMessages(Sequence):
+    """Append-only, column oriented message history usable as CommonChatSession.messages.
+
+    Roles and names are interned, token counts and timestamps live in arrays
+    and embeddings in one contiguous float32 buffer. Indexing builds a fresh
+    CommonMessage, so changes made to it are not written back.
+    """
+
+    def __init__(self, messages: Iterable[CommonMessage] = ()):
+        self._strings: List[Optional[str]] = [None]
+        self._string_ids: Dict[Optional[str], int] = {None: 0}
+        self._roles = array("I")
+        self._names = array("I")
+        self._contents: List[str] = []
+        self._tokens = array("q")
+        self._timestamps = array("d")
+        # CSR layout, embedding i is _embeddings[_embedding_index[i]:_embedding_index[i+1]]
+        self._embeddings = array("f")
+        self._embedding_index = array("Q", [0])
+        self._has_embedding = bytearray()
+        self._sparse: Dict[int, Dict[str, Any]] = {}
+        self.extend(messages)
+
+    def _intern(self, s: Optional[str]) -> int:
+        i = self._string_ids.get(s)
+        if i is None:
+            i = self._string_ids[s] = len(self._strings)
+            self._strings.append(s)
+        return i
+
+    def append(self, m: CommonMessage):
+        self._roles.append(self._intern(m.role))
+        self._names.append(self._intern(m.name))
+        self._contents.append(m.content)
+        self._tokens.append(m.content_tokens or 0)
+        self._timestamps.append(m.last_update.timestamp())
+        if m.embedding is not None:
+            self._embeddings.extend(m.embedding)
+        self._embedding_index.append(len(self._embeddings))
+        self._has_embedding.append(m.embedding is not None)
+        sparse = {f: getattr(m, f) for f in _SPARSE_FIELDS if getattr(m, f) is not None}
+        if sparse:
+            self._sparse[len(self._contents) - 1] = sparse
+
+    def extend(self, messages: Iterable[CommonMessage]):
+        for m in messages:
+            self.append(m)
+
+    def __len__(self) -> int:
+        return len(self._contents)
+
+    def _message(self, i: int) -> CommonMessage:
+        embedding = None
+        if self._has_embedding[i]:
+            embedding = self._embeddings[self._embedding_index[i]:self._embedding_index[i + 1]].tolist()
+        return CommonMessage(
+            role=self._strings[self._roles[i]],
+            content=self._contents[i],
+            name=self._strings[self._names[i]],
+            embedding=embedding,
+            content_tokens=self._tokens[i],
+            last_update=datetime.datetime.fromtimestamp(self._timestamps[i], datetime.timezone.utc),
+            **self._sparse.get(i, {}),
+        )
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._message(j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("message index out of range")
+        return self._message(i)
+
+    def __iter__(self) -> Iterator[CommonMessage]:
+        for i in range(len(self)):
+            yield self._message(i)
+
+    ############ fast paths used by CommonChatSession, no CommonMessage is built
+
+    def iter_content_tokens(self, start: int = 0) -> Iterator[int]:
+        return iter(self._tokens[start:])
+
+    def wire(self, i: int) -> Dict[str, Any]:
+        d = {"role": self._strings[self._roles[i]], "content": self._contents[i]}
+        name = self._strings[self._names[i]]
+        if name is not None:
+            d["name"] = name
+        sparse = self._sparse.get(i)
+        if sparse:
+            d.update((k, sparse[k]) for k in ("tool_calls", "tool_call_id") if k in sparse)
+        return d
+
+    def embedding(self, i: int) -> Optional[memoryview]:
+        # zero-copy float32 view
+        if not self._has_embedding[i]:
+            return None
+        return memoryview(self._embeddings)[self._embedding_index[i]:self._embedding_index[i + 1]]
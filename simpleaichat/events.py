@@ -0,0 +1,121 @@
+import time
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, NamedTuple, Optional
+
+# typed stream events, see ChatGPTSession.stream_events. str(event) is what the
+# plain string stream would have shown for it.
+
+
+class TextDelta(NamedTuple):
+    text: str
+
+    def __str__(self):
+        return self.text
+
+
+class FunctionCallStart(NamedTuple):
+    name: str
+    call_id: Optional[str] = None
+    index: int = 0
+    gpt_name: str = ''
+
+    def __str__(self):
+        return f"\n{self.gpt_name} is using {self.name} with args: \n"
+
+
+class ArgumentsDelta(NamedTuple):
+    arguments: str
+    call_id: Optional[str] = None
+    index: int = 0
+
+    def __str__(self):
+        return self.arguments
+
+
+class ToolResult(NamedTuple):
+    name: str
+    args: Any
+    result: Any
+    call_id: Optional[str] = None
+
+    def __str__(self):
+        return f"\n{self.name} ( {self.args} ) ==> {self.result}\n"
+
+
+class Done(NamedTuple):
+    usage: Optional[Dict[str, int]] = None
+    finish_reason: Optional[str] = None
+
+    def __str__(self):
+        return ''
+
+
+class _Coalescer:
+    """Merges runs of TextDelta / ArgumentsDelta (of the same call) into one event.
+
+    A run is flushed when it reaches max_chars, when max_delay seconds have passed
+    since its first delta, or when any other event arrives. The delay is checked
+    as deltas arrive, nothing is flushed by a timer.
+    """
+
+    def __init__(self, max_chars: int = 1024, max_delay: Optional[float] = 0.05):
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self._kind = None
+        self._parts = []
+        self._size = 0
+        self._started = 0.0
+
+    def _key(self, event):
+        if type(event) is TextDelta:
+            return TextDelta
+        if type(event) is ArgumentsDelta:
+            return ArgumentsDelta, event.call_id, event.index
+        return None
+
+    def flush(self):
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        event = TextDelta(text) if self._kind is TextDelta else ArgumentsDelta(text, self._kind[1], self._kind[2])
+        self._kind, self._parts, self._size = None, [], 0
+        return event
+
+    def push(self, event):
+        # yields the events that are ready to go out
+        key = self._key(event)
+        if key is None:
+            pending = self.flush()
+            if pending is not None:
+                yield pending
+            yield event
+            return
+        if key != self._kind:
+            pending = self.flush()
+            if pending is not None:
+                yield pending
+            self._kind = key
+            self._started = time.monotonic()
+        part = event.text if key is TextDelta else event.arguments
+        self._parts.append(part)
+        self._size += len(part)
+        if self._size >= self.max_chars or (self.max_delay is not None and time.monotonic() - self._started >= self.max_delay):
+            yield self.flush()
+
+
+def coalesce(events: Iterable[Any], max_chars: int = 1024, max_delay: Optional[float] = 0.05) -> Iterator[Any]:
+    coalescer = _Coalescer(max_chars, max_delay)
+    for event in events:
+        yield from coalescer.push(event)
+    pending = coalescer.flush()
+    if pending is not None:
+        yield pending
+
+
+async def acoalesce(events: AsyncIterator[Any], max_chars: int = 1024, max_delay: Optional[float] = 0.05) -> AsyncIterator[Any]:
+    coalescer = _Coalescer(max_chars, max_delay)
+    async for event in events:
+        for ready in coalescer.push(event):
+            yield ready
+    pending = coalescer.flush()
+    if pending is not None:
+        yield pending
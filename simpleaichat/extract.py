@@ -0,0 +1,136 @@
+import re
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+# html -> text for the browse tools. The C-backed parsers are optional,
+# the first importable engine in ENGINE_ORDER is used by default.
+ENGINE_ORDER = ("selectolax", "lxml", "bs4")
+_SKIP_TAGS = ("script", "style")
+# what str.splitlines breaks on
+_LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+_LINE_BREAK = re.compile(f"[{_LINE_BREAKS}]")
+# text of a single long line gets split into phrases every this many characters
+_FLUSH_CHARS = 1 << 16
+# lxml refuses str input that still declares an encoding, the text is already decoded
+_XML_DECLARATION = re.compile(r"^\s*<\?xml[^>]*\?>")
+
+
+def _selectolax_strings(html: str) -> Iterator[str]:
+    from selectolax.lexbor import LexborHTMLParser
+    tree = LexborHTMLParser(html)
+    tree.strip_tags(list(_SKIP_TAGS))
+    root = tree.root
+    if root is None:
+        return
+    for node in root.traverse(include_text=True):
+        if node.tag == "-text":
+            yield node.text_content
+
+
+def _lxml_strings(html: str) -> Iterator[str]:
+    import lxml.html
+    from lxml.etree import ParserError
+    html = _XML_DECLARATION.sub("", html, count=1)
+    if not html.strip():
+        return
+    try:
+        root = lxml.html.document_fromstring(html)
+    except ParserError:
+        # nothing but comments or a doctype
+        return
+    for el in list(root.iter(*_SKIP_TAGS)):
+        # drop the element but keep the text that follows it
+        el.drop_tree()
+    yield from root.itertext()
+
+
+def _bs4_strings(html: str) -> Iterator[str]:
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, "html.parser")
+    for script in soup(list(_SKIP_TAGS)):
+        script.extract()
+    yield soup.get_text()
+
+
+_ENGINES: Dict[str, Callable[[str], Iterable[str]]] = {
+    "selectolax": _selectolax_strings,
+    "lxml": _lxml_strings,
+    "bs4": _bs4_strings,
+}
+_MODULES = {"selectolax": "selectolax.lexbor", "lxml": "lxml.html", "bs4": "bs4"}
+_default_engine: Optional[str] = None
+
+
+def available_engines():
+    found = []
+    for name in ENGINE_ORDER:
+        try:
+            __import__(_MODULES[name])
+            found.append(name)
+        except ImportError:
+            pass
+    return found
+
+
+def get_text_engine() -> str:
+    global _default_engine
+    if _default_engine is None:
+        engines = available_engines()
+        if not engines:
+            raise ImportError("html_to_text needs one of selectolax, lxml or beautifulsoup4")
+        _default_engine = engines[0]
+    return _default_engine
+
+
+def set_text_engine(name: Optional[str]):
+    # None goes back to auto detection
+    global _default_engine
+    if name is not None and name not in _ENGINES:
+        raise ValueError(f"unknown html engine {name}, expected one of {ENGINE_ORDER}")
+    _default_engine = name
+
+
+def _phrases(text: str) -> Iterator[str]:
+    # stripping each phrase is the same as stripping the line first
+    for phrase in text.split("  "):
+        phrase = phrase.strip()
+        if phrase:
+            yield phrase
+
+
+def _normalize(strings: Iterable[str]) -> Iterator[str]:
+    """Same cleanup as before: strip every line, split on double spaces, drop empty chunks.
+    Works on complete lines as they arrive, so callers can stop early."""
+    parts, added = [], 0
+    for s in strings:
+        parts.append(s)
+        added += len(s)
+        # minified pages come as many small strings without a line break,
+        # they are joined only once a break shows up or enough text piled up
+        if added < _FLUSH_CHARS and not _LINE_BREAK.search(s):
+            continue
+        pending = "".join(parts)
+        lines = pending.splitlines()
+        # the last line may continue in the next string
+        tail = lines.pop() if pending and pending[-1] not in _LINE_BREAKS else ""
+        for line in lines:
+            yield from _phrases(line)
+        # of an unfinished line everything up to its last double space is final
+        pieces = tail.split("  ")
+        for piece in pieces[:-1]:
+            yield from _phrases(piece)
+        parts, added = [pieces[-1]], 0
+    yield from _phrases("".join(parts))
+
+
+def html_to_text(html: str, max_chars: Optional[int] = None, engine: Optional[str] = None) -> str:
+    """Visible text of html, one phrase per line. Stops after max_chars characters."""
+    chunks = _normalize(_ENGINES[engine or get_text_engine()](html))
+    if max_chars is None:
+        return "\n".join(chunks)
+    out, size = [], 0
+    for chunk in chunks:
+        out.append(chunk)
+        size += len(chunk) + 1
+        if size > max_chars:
+            break
+    return "\n".join(out)[:max_chars]
@@ -0,0 +1,173 @@
+import asyncio
+import re
+import threading
+import time
+import weakref
+from collections import defaultdict
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from utils import USER_AGENT
+
+# pages that only render client side say so in their static html
+JS_REQUIRED_MARKERS = (
+    "enable javascript", "javascript is required", "javascript is disabled", "requires javascript",
+    "you need to enable js", "please enable js", "checking your browser",
+)
+_TAGS = re.compile(r"<script.*?</script>|<style.*?</style>|<[^>]+>", re.S | re.I)
+
+FAST, BROWSER = "fast", "browser"
+# besides text/*, the content types html_to_text can make sense of
+TEXT_CONTENT_TYPES = ("application/json", "application/xml", "application/xhtml+xml", "application/javascript")
+
+
+def is_text_content_type(content_type: str) -> bool:
+    # a missing content type is sniffed as html
+    mime = content_type.split(";", 1)[0].strip().lower()
+    return not mime or mime.startswith("text/") or mime in TEXT_CONTENT_TYPES or mime.endswith(("+json", "+xml"))
+
+
+class UnsupportedContentType(ValueError):
+    def __init__(self, url: str, content_type: str):
+        super().__init__(f"unsupported content-type {content_type} at {url}, only text, json and xml pages can be read")
+        self.url = url
+        self.content_type = content_type
+
+
+class PageFetcher:
+    """Fetches pages with a pooled HTTP client and escalates to a BrowserPool only when needed.
+
+    A page goes to the browser when the request fails, the body has less than
+    `min_text` visible characters, or it contains a JS_REQUIRED_MARKERS phrase.
+    Responses that aren't text, json or xml (pdf, images, ...) raise
+    UnsupportedContentType, a browser wouldn't give readable text for them either.
+    Latency of both paths is tracked per domain, see stats().
+    """
+
+    def __init__(self, pool=None, timeout: float = 10.0, min_text: int = 200,
+                 max_connections: int = 20, transport: Optional[httpx.BaseTransport] = None,
+                 async_transport: Optional[httpx.AsyncBaseTransport] = None):
+        # None uses browser.get_browser_pool(), selenium is only imported on the first escalation
+        self.pool = pool
+        self.timeout = timeout
+        self.min_text = min_text
+        self.limits = httpx.Limits(max_connections=max_connections)
+        self.headers = {"User-Agent": USER_AGENT}
+        self._transport = transport
+        self._async_transport = async_transport
+        self._client: Optional[httpx.Client] = None
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        # domain -> path -> [count, total seconds]
+        self._stats: Dict[str, Dict[str, list]] = defaultdict(lambda: {FAST: [0, 0.0], BROWSER: [0, 0.0]})
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None or self._client.is_closed:
+            with self._lock:
+                if self._client is None or self._client.is_closed:
+                    self._client = httpx.Client(limits=self.limits, timeout=self.timeout, headers=self.headers,
+                                                follow_redirects=True, transport=self._transport)
+        return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None or client.is_closed:
+            client = self._async_clients[loop] = httpx.AsyncClient(limits=self.limits, timeout=self.timeout,
+                                                                   headers=self.headers, follow_redirects=True,
+                                                                   transport=self._async_transport)
+        return client
+
+    def get_pool(self):
+        if self.pool is None:
+            from browser import get_browser_pool
+            return get_browser_pool()
+        return self.pool
+
+    def needs_browser(self, response: Optional[httpx.Response]) -> bool:
+        if response is None or response.is_error:
+            return True
+        content_type = response.headers.get("content-type", "")
+        if content_type and "html" not in content_type:
+            return False
+        html = response.text
+        lowered = html.lower()
+        if any(m in lowered for m in JS_REQUIRED_MARKERS):
+            return True
+        return len(" ".join(_TAGS.sub(" ", html).split())) < self.min_text
+
+    @staticmethod
+    def _check_content_type(url: str, response: Optional[httpx.Response]):
+        if response is not None and not response.is_error:
+            content_type = response.headers.get("content-type", "")
+            if not is_text_content_type(content_type):
+                raise UnsupportedContentType(url, content_type)
+
+    def _record(self, url: str, path: str, seconds: float):
+        with self._lock:
+            entry = self._stats[urlsplit(url).netloc][path]
+            entry[0] += 1
+            entry[1] += seconds
+
+    def fetch(self, url: str) -> Tuple[str, str]:
+        """Returns (html, "fast" or "browser"), raises UnsupportedContentType for binary responses."""
+        started = time.perf_counter()
+        try:
+            response = self.client.get(url)
+        except httpx.HTTPError:
+            response = None
+        self._check_content_type(url, response)
+        if not self.needs_browser(response):
+            self._record(url, FAST, time.perf_counter() - started)
+            return response.text, FAST
+        # browser latency includes the failed fast attempt, it's what escalation costs
+        html = self.get_pool().fetch(url)
+        self._record(url, BROWSER, time.perf_counter() - started)
+        return html, BROWSER
+
+    async def afetch(self, url: str) -> Tuple[str, str]:
+        started = time.perf_counter()
+        try:
+            response = await self.async_client.get(url)
+        except httpx.HTTPError:
+            response = None
+        self._check_content_type(url, response)
+        if not self.needs_browser(response):
+            self._record(url, FAST, time.perf_counter() - started)
+            return response.text, FAST
+        # selenium is blocking
+        html = await asyncio.get_running_loop().run_in_executor(None, self.get_pool().fetch, url)
+        self._record(url, BROWSER, time.perf_counter() - started)
+        return html, BROWSER
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per domain: page count and mean latency of each path."""
+        with self._lock:
+            return {domain: {path: dict(count=n, mean_latency=total / n if n else 0.0) for path, (n, total) in paths.items()}
+                    for domain, paths in self._stats.items()}
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+
+
+_DEFAULT_FETCHER: Optional[PageFetcher] = None
+_DEFAULT_FETCHER_LOCK = threading.Lock()
+
+
+def get_page_fetcher() -> PageFetcher:
+    global _DEFAULT_FETCHER
+    if _DEFAULT_FETCHER is None:
+        with _DEFAULT_FETCHER_LOCK:
+            if _DEFAULT_FETCHER is None:
+                _DEFAULT_FETCHER = PageFetcher()
+    return _DEFAULT_FETCHER
+
+
+def set_page_fetcher(fetcher: PageFetcher):
+    global _DEFAULT_FETCHER
+    _DEFAULT_FETCHER = fetcher
@@ -0,0 +1,113 @@
+import logging
+import math
+import threading
+from typing import Any, Dict, Optional
+
+# metrics a session records, values are seconds unless noted
+#   payload      building the request body
+#   network      sending the request until the response (headers, when streaming) is back
+#   ttft         request start until the first streamed chunk
+#   chunk_gap    between two streamed chunks
+#   tokens_per_sec  completion tokens / generation time (count/s)
+#   tool         one tool call, label is the tool name
+#   encode       tokenizing a message in add_msg
+#   cache_hit / cache_miss  1 per lookup, label is completion / semantic / the tool name
+
+
+class Instrumentation:
+    """Receives the measurements of a session, see ChatGPTSession.set_instrumentation.
+    Sessions without one skip all timing."""
+
+    def record(self, name: str, value: float, label: Optional[str] = None, **attrs):
+        raise NotImplementedError
+
+
+class LoggingExporter(Instrumentation):
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.DEBUG):
+        self.logger = logger if logger is not None else logging.getLogger("simpleaichat")
+        self.level = level
+
+    def record(self, name, value, label=None, **attrs):
+        if self.logger.isEnabledFor(self.level):
+            key = name if label is None else f"{name}[{label}]"
+            self.logger.log(self.level, "%s=%.6g %s", key, value, attrs if attrs else "")
+
+
+class Histogram:
+    """Log-bucketed histogram, about 5% relative error on quantiles."""
+
+    GROWTH = 1.1
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.zeros = 0
+        self.buckets: Dict[int, int] = {}
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value <= 0:
+            self.zeros += 1
+        else:
+            i = math.floor(math.log(value, self.GROWTH))
+            self.buckets[i] = self.buckets.get(i, 0) + 1
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if rank < seen:
+                # bucket midpoint, clamped to what was actually seen
+                return min(max(self.GROWTH ** (i + 0.5), self.min), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return dict(count=self.count, mean=self.total / self.count if self.count else 0.0,
+                    min=self.min if self.count else 0.0, p50=self.quantile(0.5), p90=self.quantile(0.9),
+                    p99=self.quantile(0.99), max=self.max if self.count else 0.0)
+
+
+class HistogramRegistry(Instrumentation):
+    """In-process histograms, one per metric name (and label)."""
+
+    def __init__(self):
+        self._histograms: Dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, value, label=None, **attrs):
+        key = name if label is None else f"{name}[{label}]"
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.add(value)
+
+    def get(self, key: str) -> Optional[Histogram]:
+        return self._histograms.get(key)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {key: h.summary() for key, h in sorted(self._histograms.items())}
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+class Tee(Instrumentation):
+    def __init__(self, *exporters: Instrumentation):
+        self.exporters = exporters
+
+    def record(self, name, value, label=None, **attrs):
+        for exporter in self.exporters:
+            exporter.record(name, value, label, **attrs)
@@ -0,0 +1,173 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+import orjson
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, with Nagle on every response waits for a delayed ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = orjson.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        server: MockChatServer = self.server.mock
+        server.record(self.headers, body)
+        if server.latency:
+            time.sleep(server.latency)
+        call = server.tool_call_for(body)
+        text = server.reply_for(body) if call is None else call[1]
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            if call is None:
+                deltas = [{"content": delta} for delta in server.split_reply(text)]
+                finish = "stop"
+            else:
+                deltas = [server.call_delta(body, call[0], "")] + [server.call_delta(body, None, part)
+                                                                   for part in server.split_reply(text)]
+                finish = server.call_finish_reason(body)
+            for delta in deltas:
+                self._write_event({"choices": [{"index": 0, "delta": delta}]})
+                if server.chunk_delay:
+                    time.sleep(server.chunk_delay)
+            self._write_event({"choices": [{"index": 0, "delta": {}, "finish_reason": finish}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                # like the api: one last chunk with empty choices
+                self._write_event({"choices": [], "usage": server.usage_for(body, text)})
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        else:
+            if call is None:
+                message, finish = {"role": "assistant", "content": text}, "stop"
+            else:
+                message, finish = server.call_message(body, *call), server.call_finish_reason(body)
+            data = orjson.dumps({
+                "choices": [{"index": 0, "message": message, "finish_reason": finish}],
+                "usage": server.usage_for(body, text),
+            })
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    def _write_event(self, data: Dict[str, Any]):
+        self._write_chunk(b"data: " + orjson.dumps(data) + b"\n\n")
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class MockChatServer:
+    """Local stand-in for the chat completions endpoint, runs on a background thread.
+
+    with MockChatServer() as server:
+        ss = ModelSessionFactory.buildChatGPTSession(api_url=server.url)
+
+    latency      seconds before each response starts
+    chunk_delay  seconds between two streamed chunks
+    chunk_words  words per streamed chunk
+    tool_call    (name, json arguments) to answer requests that offer tools with;
+                 by default the first offered tool with its required arguments set
+                 to "mock". Requests that end on a tool result get a plain reply.
+    keep_requests  keep every request body in .requests, off for long benchmark runs
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, reply: Optional[str] = None,
+                 latency: float = 0.0, chunk_delay: float = 0.0, chunk_words: int = 1,
+                 tool_call: Optional[Tuple[str, str]] = None, keep_requests: bool = True):
+        self.reply = reply
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_words = chunk_words
+        self.tool_call = tool_call
+        self.keep_requests = keep_requests
+        self.requests: List[Dict[str, Any]] = []
+        self.authorizations: List[str] = []
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), MockChatHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def record(self, headers, body):
+        if not self.keep_requests:
+            return
+        with self._lock:
+            self.requests.append(body)
+            self.authorizations.append(headers.get("Authorization", ""))
+
+    def reply_for(self, body) -> str:
+        if self.reply is not None:
+            return self.reply
+        return f"echo: {body['messages'][-1]['content']}"
+
+    def split_reply(self, text: str) -> List[str]:
+        words = text.split(" ")
+        n = max(1, self.chunk_words)
+        return [("" if i == 0 else " ") + " ".join(words[i:i + n]) for i in range(0, len(words), n)]
+
+    ############ function calls
+
+    def tool_call_for(self, body) -> Optional[Tuple[str, str]]:
+        offered = [t["function"] for t in body.get("tools") or []] or body.get("functions") or []
+        if not offered or body["messages"][-1]["role"] in ("tool", "function"):
+            return None
+        if self.tool_call is not None:
+            return self.tool_call
+        schema = offered[0]
+        required = (schema.get("parameters") or {}).get("required") or []
+        return schema["name"], orjson.dumps({name: "mock" for name in required}).decode()
+
+    def call_finish_reason(self, body) -> str:
+        return "tool_calls" if body.get("tools") else "function_call"
+
+    def call_message(self, body, name: str, arguments: str) -> Dict[str, Any]:
+        if body.get("tools"):
+            return {"role": "assistant", "content": None, "tool_calls": [
+                {"id": "call_0", "type": "function", "function": {"name": name, "arguments": arguments}}]}
+        return {"role": "assistant", "content": None, "function_call": {"name": name, "arguments": arguments}}
+
+    def call_delta(self, body, name: Optional[str], arguments: str) -> Dict[str, Any]:
+        # the first delta of a call carries its name (and id), the rest only argument text
+        function = {"arguments": arguments} if name is None else {"name": name, "arguments": arguments}
+        if body.get("tools"):
+            call = {"index": 0, "function": function}
+            if name is not None:
+                call.update(id="call_0", type="function")
+            return {"tool_calls": [call]}
+        return {"function_call": function}
+
+    def usage_for(self, body, text: str) -> Dict[str, int]:
+        prompt = sum(len(m.get("content") or "") for m in body["messages"]) // 4
+        completion = len(text) // 4
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
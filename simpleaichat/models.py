@@ -5,47 +5,133 @@ from pydantic import BaseModel, SecretStr, HttpUrl, Field
 from typing import List, Dict, Union, Optional, Set, Any
 import csv
 import inspect
-import tiktoken
 import json
+import orjson
+import threading
+import time
+from bisect import bisect_left
 
+from cache import LRUCache
+
+# ChatML wraps every message in ~4 extra tokens (role, separators)
+MESSAGE_TOKEN_OVERHEAD = 4
+# fields of CommonMessage sent to the chat completions api
+WIRE_FIELDS = frozenset({"role", "content", "name", "tool_calls", "tool_call_id"})
 
 def now_tz():
     # Need datetime w/ timezone for cleanliness
     # https://stackoverflow.com/a/24666683
     return datetime.datetime.now(datetime.timezone.utc)
 
+# Map Python types to more generic strings
+_JSON_TYPES = {
+    int: "integer",float: "number",
+    str: "string",bool: "boolean",
+    list: "array",dict: "object"
+    # ... add more mappings if needed
+}
+# Function subclass -> (openai schema dict, the same schema as orjson bytes), built once per class
+_FUNCTION_SCHEMAS: Dict[type, tuple] = {}
+# Function subclass -> LRUCache of call results, shared by every instance and session
+_RESULT_CACHES: Dict[type, LRUCache] = {}
+_RESULT_CACHES_LOCK = threading.Lock()
+
 class Function(BaseModel):
     class Parameter(BaseModel):
         type: str
         description: str
     name: str = None
     description: str = None
-    _properties: Dict[str, Parameter] = {}
-    parameters: Dict[str, Any] = {"type": "object",'properties':_properties}
-    required: List[str] = []
+    parameters: Dict[str, Any] = Field(default_factory=lambda: {"type": "object", "properties": {}})
+    required: List[str] = Field(default_factory=list)
     _parameters_description: Dict[str, str] = {}
+    # seconds before a parallel tool call is abandoned, None uses the session's tool_timeout
+    _timeout: Optional[float] = None
+    # results keyed on the call arguments, opt in per subclass with _cacheable = True
+    _cacheable: bool = False
+    _cache_ttl: Optional[float] = None
+    _cache_maxsize: Optional[int] = 256
+
+    @classmethod
+    def _private_default(cls, name):
+        return cls.__private_attributes__[name].get_default()
+
+    @classmethod
+    def result_cache(cls) -> Optional[LRUCache]:
+        if not cls._private_default('_cacheable'):
+            return None
+        cache = _RESULT_CACHES.get(cls)
+        if cache is None:
+            with _RESULT_CACHES_LOCK:
+                cache = _RESULT_CACHES.get(cls)
+                if cache is None:
+                    cache = _RESULT_CACHES[cls] = LRUCache(cls._private_default('_cache_ttl'),
+                                                           cls._private_default('_cache_maxsize'), deterministic_only=False)
+        return cache
+
+    @classmethod
+    def cache_stats(cls) -> Optional[Dict[str, Any]]:
+        cache = cls.result_cache()
+        return cache.stats() if cache is not None else None
+
+    @staticmethod
+    def _cache_key(args: Dict[str, Any]) -> bytes:
+        return orjson.dumps(args, option=orjson.OPT_SORT_KEYS)
+
+    def cache_get(self, args: Dict[str, Any]):
+        """(key, cached result or None), key is None when the tool isn't cacheable."""
+        cache = self.result_cache()
+        if cache is None:
+            return None, None
+        key = self._cache_key(args)
+        return key, cache.get(key)
+
+    def cache_set(self, key, res):
+        if key is not None and res is not None:
+            self.result_cache().set(key, res)
+
+    def call(self, **args):
+        key, res = self.cache_get(args)
+        if res is None:
+            res = self(**args)
+            self.cache_set(key, res)
+        return res
+
+    @classmethod
+    def openai_schema(cls):
+        """(schema, json bytes) of this tool, shared by every instance, session and request. Do not mutate."""
+        cached = _FUNCTION_SCHEMAS.get(cls)
+        if cached is None:
+            descriptions = cls.__private_attributes__['_parameters_description'].get_default() or {}
+            properties, required = {}, []
+            for name, param in list(inspect.signature(cls.__call__).parameters.items())[1:]:
+                properties[name] = dict(type=_JSON_TYPES.get(param.annotation, "unknown"), description=descriptions.get(name,''))
+                if param.default is inspect._empty:
+                    required.append(name)
+            schema = dict(name=cls.__name__, description=cls.model_fields['description'].default,
+                          parameters=dict(type="object", properties=properties, required=required))
+            cached = _FUNCTION_SCHEMAS[cls] = (schema, orjson.dumps(schema))
+        return cached
 
     def _extract_signature(self):
-        self.name=self.__class__.__name__
-        sig = inspect.signature(self.__call__)
-        # Map Python types to more generic strings
-        type_map = {
-            int: "integer",float: "number",
-            str: "string",bool: "boolean",
-            list: "array",dict: "object"
-            # ... add more mappings if needed
-        }
-        for name, param in sig.parameters.items():
-            param_type = type_map.get(param.annotation, "unknown")
-            self._properties[name] = Function.Parameter(type=param_type, description=self._parameters_description.get(name,''))
-            if param.default is inspect._empty:
-                self.required.append(name)
-        self.parameters['properties']=self._properties
+        schema = self.openai_schema()[0]
+        self.name = schema['name']
+        self.parameters = dict(type="object", properties=dict(schema['parameters']['properties']))
+        self.required = list(schema['parameters']['required'])
+
     def get_class_name(self):
         return self.__class__.__name__
     
     def get_openai_description(self):
-        return self.model_dump()
+        if self.description == self.__class__.model_fields['description'].default:
+            return self.openai_schema()[0]
+        return dict(self.openai_schema()[0], description=self.description)
+
+    def get_openai_fragment(self):
+        # pre-serialized description, orjson copies it into the request body as is
+        if self.description == self.__class__.model_fields['description'].default:
+            return orjson.Fragment(self.openai_schema()[1])
+        return orjson.Fragment(orjson.dumps(self.get_openai_description()))
 
     def json(self):
         return self.model_dump_json()
@@ -56,6 +142,9 @@ class CommonMessage(BaseModel):
     embedding: Optional[List[float]] = None
     name: Optional[str] = None
     function_call: Optional[str] = None
+    # tools api: calls requested by an assistant message / the call a tool message answers
+    tool_calls: Optional[List[Dict[str, Any]]] = None
+    tool_call_id: Optional[str] = None
     last_update: datetime.datetime = Field(default_factory=now_tz)
     finish_reason: Optional[str] = None
     prompt_length: Optional[int] = None
@@ -63,6 +152,34 @@ class CommonMessage(BaseModel):
     total_length: Optional[int] = None
     content_tokens: Optional[int] = 0
 
+    # memoized model_dump(include=WIRE_FIELDS), updated in place when a wire field changes
+    _wire: Optional[Dict[str, Any]] = None
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in WIRE_FIELDS and self.__pydantic_private__ and self._wire is not None:
+            wire = self.model_dump(include=WIRE_FIELDS, exclude_none=True)
+            self._wire.clear()
+            self._wire.update(wire)
+
+    def __copy__(self):
+        res = super().__copy__()
+        # a copy serializes on its own, sharing _wire would let it change what the original sends
+        res._wire = None
+        return res
+
+    def __deepcopy__(self, memo=None):
+        res = super().__deepcopy__(memo)
+        res._wire = None
+        return res
+
+    def to_wire(self) -> Dict[str, Any]:
+        # straight from the private dict, pydantic's private attribute lookup costs more than the rest
+        wire = self.__pydantic_private__['_wire']
+        if wire is None:
+            wire = self._wire = self.model_dump(include=WIRE_FIELDS, exclude_none=True)
+        return wire
+
     @staticmethod
     def custom_construct_list(d=[{'system':'FREE'},{'user':'hello!'}]):
         return [CommonMessage.custom_construct_one(ii) for ii in d]
@@ -105,6 +222,17 @@ class CommonChatSession(BaseModel):
     
     _token_encoder = None    
     _last_prompt:str = ''
+    # the history object the caches below were built for, assigning a new one resets them
+    _cached_history: Any = None
+    # running prefix sum of message token costs, _token_prefix[i] == cost of messages[:i]
+    _token_prefix: List[int] = [0]
+    # the messages behind _token_prefix, to notice ones replaced in place (plain lists only)
+    _token_refs: List[Any] = []
+    # wire dicts parallel to a ColumnarMessages history, filled for messages[_wire_from:]
+    _wire_cache: List[Optional[Dict[str, Any]]] = []
+    _wire_from: int = 0
+    # instrument.Instrumentation, None records nothing
+    _instrumentation: Any = None
 
     def __str__(self) -> str:
         sess_start_str = self.created_at.strftime("%Y-%m-%d %H:%M:%S")
@@ -113,26 +241,117 @@ class CommonChatSession(BaseModel):
         - {len(self.messages):,} Messages
         - Last message sent at {last_message_str}"""
 
+    def new_msg(self,m = {'user':'Hello!'}, name=None) -> CommonMessage:
+        """The CommonMessage add_msg would append for m, token counted but not added."""
+        if type(m) is not CommonMessage:
+            inst = self._instrumentation
+            started = time.perf_counter() if inst is not None else 0
+            m = CommonMessage.custom_construct_one(m).calc_tokens(self.get_token_encoder())
+            if inst is not None:inst.record('encode',time.perf_counter()-started,tokens=m.content_tokens)
+        if name is not None:
+            m.name = name
+        return m
+
     def add_msg(self,m = {'user':'Hello!'}, name=None):
+        # the added message, False when it could not be built
         try:
-            if type(m) is not CommonMessage:
-                m = CommonMessage.custom_construct_one(m).calc_tokens(self.get_token_encoder())
+            m = self.new_msg(m, name)
         except Exception as e:
             print(e)
             return False
-        if name is not None:
-            m.name = name
         self.messages.append(m)
-        return True
+        self._sync_token_prefix()
+        return m
+
+    def _check_history(self):
+        # messages may be appended or replaced without add_msg (e.g. load_from_dict)
+        if self.messages is not self._cached_history or len(self._token_prefix) - 1 > len(self.messages):
+            self._cached_history = self.messages
+            self._token_prefix, self._token_refs = [0], []
+            self._wire_cache, self._wire_from = [], 0
+
+    def _verify_token_prefix(self, start: int) -> bool:
+        """Drops the prefix sums from the first message in messages[start:] that was replaced
+        in place (pop + append, item assignment), True if it did."""
+        if not isinstance(self.messages, list):
+            return False
+        refs = self._token_refs
+        for i in range(max(start, 0), len(refs)):
+            if self.messages[i] is not refs[i]:
+                del self._token_prefix[i + 1:], refs[i:]
+                return True
+        return False
+
+    def _sync_token_prefix(self, verify_from: Optional[int] = None):
+        self._check_history()
+        if verify_from is not None:
+            self._verify_token_prefix(verify_from)
+        start = len(self._token_prefix) - 1
+        if hasattr(self.messages, 'iter_content_tokens'):
+            tokens = self.messages.iter_content_tokens(start)
+        else:
+            self._token_refs.extend(self.messages[start:])
+            tokens = (m.content_tokens for m in self.messages[start:])
+        for t in tokens:
+            self._token_prefix.append(self._token_prefix[-1] + t + MESSAGE_TOKEN_OVERHEAD)
+        return self._token_prefix
+
+    def recent_messages_within(self, budget: int) -> int:
+        """Index of the oldest message such that messages[index:] fits in budget tokens.
+        The newest message is always kept, even when it alone is over the budget."""
+        prefix = self._sync_token_prefix()
+        while True:
+            index = bisect_left(prefix, prefix[-1] - max(budget, 0))
+            # only messages[index-1:] decide the index, recount from the first replaced one there
+            if not self._verify_token_prefix(index - 1):
+                break
+            prefix = self._sync_token_prefix()
+        return max(0, min(index, len(self.messages) - 1))
+
+    def get_wire_messages(self, start: int = 0) -> List[Dict[str, Any]]:
+        """Wire dicts of messages[start:], each message serializes once and keeps its dict.
+        The dicts are shared with the messages and must not be mutated by the caller."""
+        wire = getattr(self.messages, 'wire', None)
+        if wire is None:
+            # a plain list can be edited in place, so ask every message in the window
+            return [m.to_wire() for m in self.messages[start:]]
+        # ColumnarMessages builds wire dicts without a CommonMessage and is append only,
+        # the cache covers it until the history is replaced
+        self._check_history()
+        cache = self._wire_cache
+        lo = len(cache)
+        if lo < len(self.messages):
+            if start > lo:
+                cache.extend([None] * (start - lo))
+                self._wire_from = lo = start
+            cache.extend(wire(i) for i in range(lo, len(self.messages)))
+        if start < self._wire_from:
+            for i in range(start, self._wire_from):
+                cache[i] = wire(i)
+            self._wire_from = start
+        return cache[start:]
+
+    def use_columnar_history(self):
+        """Move the history into a compact columnar.ColumnarMessages store."""
+        from columnar import ColumnarMessages
+        if not isinstance(self.messages, ColumnarMessages):
+            self.messages = ColumnarMessages(self.messages)
+        return self
 
     def to_dict(self):
-        return self.model_dump()
+        if isinstance(self.messages, list):
+            return self.model_dump()
+        d = self.model_dump(exclude={'messages'})
+        d['messages'] = [m.model_dump() for m in self.messages]
+        return d
     
     def load_from_dict(self,d):
         d = dict(**d)
         d['system_message'] = CommonMessage(**d['system_message']) if 'system_message' in d.keys() else None
         d['messages'] = [CommonMessage(**i) for i in d['messages']]
-        return self.model_copy(update=d)
+        res = self.model_copy(update=d)
+        res._cached_history = None
+        return res
 
     # def save_session(
     #     self,
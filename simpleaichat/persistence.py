@@ -0,0 +1,282 @@
+import mmap
+import os
+import struct
+from array import array
+from collections.abc import Sequence
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import orjson
+from pydantic import SecretStr
+
+from models import CommonMessage, CommonChatSession, WIRE_FIELDS
+from chatgpt import ChatGPTSession
+
+# snapshot.bin: message records | session meta | index (offset, length, content_tokens per message) | footer
+# journal.log: records appended since the snapshot, each b"M"/b"S"/b"B" + u32 length + payload.
+# A journal opens with a b"B" record holding the generation of the snapshot it extends; every
+# compaction or rewrite writes the next generation, so a journal left behind by a crash between
+# replacing the snapshot and truncating the journal is recognized as already folded in.
+SNAPSHOT_MAGIC = b"SAICSNP1"
+SNAPSHOT_MAGIC_V2 = b"SAICSNP2"
+_FOOTER = struct.Struct("<QQQQ8s")
+# v2 adds the generation before the magic
+_FOOTER_V2 = struct.Struct("<QQQQQ8s")
+_RECORD = struct.Struct("<cI")
+_GENERATION = struct.Struct("<Q")
+MESSAGE_RECORD, META_RECORD, BASE_RECORD = b"M", b"S", b"B"
+
+
+def _unpack_footer(tail: bytes) -> Tuple[int, int, int, int, int]:
+    """(meta offset, meta length, index offset, count, generation) from the last bytes of a snapshot."""
+    magic = tail[-8:]
+    if magic == SNAPSHOT_MAGIC_V2:
+        return _FOOTER_V2.unpack(tail[-_FOOTER_V2.size:])[:5]
+    if magic == SNAPSHOT_MAGIC:
+        return _FOOTER.unpack(tail[-_FOOTER.size:])[:4] + (0,)
+    raise ValueError("not a session snapshot")
+
+
+def _dump_message(m: CommonMessage) -> bytes:
+    return m.model_dump_json(exclude_none=True).encode()
+
+
+def _dump_meta(session: CommonChatSession) -> bytes:
+    # the api key is never written to disk
+    return orjson.dumps(session.model_dump(mode="json", exclude={"messages", "auth"}))
+
+
+class LazyMessages(Sequence):
+    """History backed by a snapshot file, records are only parsed when accessed.
+
+    Messages appended after loading are kept in memory until the next checkpoint.
+    """
+
+    def __init__(self, snapshot: Optional["Snapshot"], journal: List[bytes]):
+        self._snapshot = snapshot
+        self._base = len(snapshot) if snapshot is not None else 0
+        self._journal = journal
+        self._tail: List[CommonMessage] = []
+
+    def __len__(self) -> int:
+        return self._base + len(self._journal) + len(self._tail)
+
+    def raw(self, i: int) -> bytes:
+        if i < self._base:
+            return self._snapshot.record(i)
+        i -= self._base
+        if i < len(self._journal):
+            return self._journal[i]
+        return _dump_message(self._tail[i - len(self._journal)])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("message index out of range")
+        tail = i - self._base - len(self._journal)
+        if tail >= 0:
+            return self._tail[tail]
+        return CommonMessage.model_validate_json(self.raw(i))
+
+    def __iter__(self) -> Iterator[CommonMessage]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, m: CommonMessage):
+        self._tail.append(m)
+
+    def iter_content_tokens(self, start: int = 0) -> Iterator[int]:
+        if start < self._base:
+            yield from self._snapshot.content_tokens(start)
+        for i in range(max(start, self._base), len(self)):
+            if i - self._base < len(self._journal):
+                yield orjson.loads(self._journal[i - self._base]).get("content_tokens") or 0
+            else:
+                yield self._tail[i - self._base - len(self._journal)].content_tokens
+
+    def wire(self, i: int) -> Dict[str, Any]:
+        if i - self._base - len(self._journal) >= 0:
+            return self[i].to_wire()
+        d = orjson.loads(self.raw(i))
+        return {k: d[k] for k in WIRE_FIELDS if d.get(k) is not None}
+
+
+class Snapshot:
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            meta_offset, meta_length, index_offset, count, self.generation = _unpack_footer(self._map[-_FOOTER_V2.size:])
+        except ValueError:
+            raise ValueError(f"{path} is not a session snapshot")
+        self.meta = orjson.loads(self._map[meta_offset:meta_offset + meta_length])
+        self._index = array("q")
+        self._index.frombytes(self._map[index_offset:index_offset + count * 3 * 8])
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def record(self, i: int) -> bytes:
+        offset, length = self._index[3 * i], self._index[3 * i + 1]
+        return self._map[offset:offset + length]
+
+    def content_tokens(self, start: int = 0):
+        return self._index[3 * start + 2::3]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    @staticmethod
+    def write(path: str, records: List[Tuple[bytes, int]], meta: bytes, generation: int = 0):
+        index = array("q")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            offset = 0
+            for data, tokens in records:
+                f.write(data)
+                index.extend((offset, len(data), tokens))
+                offset += len(data)
+            f.write(meta)
+            index_offset = offset + len(meta)
+            f.write(index.tobytes())
+            f.write(_FOOTER_V2.pack(offset, len(meta), index_offset, len(records), generation, SNAPSHOT_MAGIC_V2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+
+class SessionJournal:
+    """Snapshot + append-only journal persistence for one session directory.
+
+    checkpoint() appends only the messages added since the last call, and
+    folds the journal into a new snapshot every `compact_every` records.
+    load() maps the snapshot and parses records on access, so building the
+    recent window doesn't read the whole history.
+    """
+
+    SNAPSHOT = "snapshot.bin"
+    JOURNAL = "journal.log"
+
+    def __init__(self, path: str, compact_every: int = 1000, fsync: bool = False):
+        self.path = path
+        self.compact_every = compact_every
+        self.fsync = fsync
+        os.makedirs(path, exist_ok=True)
+        self._snapshot_path = os.path.join(path, self.SNAPSHOT)
+        self._journal_path = os.path.join(path, self.JOURNAL)
+        self._snapshot_count, self._generation = self._read_snapshot_footer()
+        self._journal_messages, self._meta, generation = self._read_journal()
+        if generation < self._generation:
+            # the snapshot already holds this journal, the crash came before it was truncated
+            open(self._journal_path, "wb").close()
+            self._journal_messages, self._meta = [], None
+        self._journal_records = len(self._journal_messages) + (self._meta is not None)
+
+    @property
+    def count(self) -> int:
+        # messages already on disk
+        return self._snapshot_count + len(self._journal_messages)
+
+    def _read_snapshot_footer(self) -> Tuple[int, int]:
+        # (message count, generation)
+        if not os.path.exists(self._snapshot_path):
+            return 0, 0
+        with open(self._snapshot_path, "rb") as f:
+            f.seek(-min(_FOOTER_V2.size, os.path.getsize(self._snapshot_path)), os.SEEK_END)
+            footer = _unpack_footer(f.read())
+        return footer[3], footer[4]
+
+    def _read_journal(self) -> Tuple[List[bytes], Optional[bytes], int]:
+        # journals written before generations existed extend generation 0
+        messages, meta, generation = [], None, 0
+        if not os.path.exists(self._journal_path):
+            return messages, meta, generation
+        with open(self._journal_path, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + _RECORD.size <= len(data):
+            kind, length = _RECORD.unpack_from(data, pos)
+            end = pos + _RECORD.size + length
+            if end > len(data):
+                break
+            record = data[pos + _RECORD.size:end]
+            if kind == MESSAGE_RECORD:
+                messages.append(record)
+            elif kind == BASE_RECORD:
+                generation = _GENERATION.unpack(record)[0]
+            else:
+                meta = record
+            pos = end
+        if pos != len(data):
+            # torn write from a crash, drop the partial record
+            with open(self._journal_path, "r+b") as f:
+                f.truncate(pos)
+        return messages, meta, generation
+
+    def checkpoint(self, session: CommonChatSession) -> int:
+        """Append messages added since the last checkpoint plus the session meta, returns how many were written."""
+        start = self.count
+        if len(session.messages) < start:
+            raise ValueError("session history is shorter than the persisted one, use rewrite()")
+        new = [_dump_message(session.messages[i]) for i in range(start, len(session.messages))]
+        meta = _dump_meta(session)
+        with open(self._journal_path, "ab") as f:
+            if self._journal_records == 0:
+                f.write(_RECORD.pack(BASE_RECORD, _GENERATION.size) + _GENERATION.pack(self._generation))
+            for data in new:
+                f.write(_RECORD.pack(MESSAGE_RECORD, len(data)) + data)
+            f.write(_RECORD.pack(META_RECORD, len(meta)) + meta)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        self._journal_messages.extend(new)
+        self._meta = meta
+        self._journal_records += len(new) + 1
+        if self._journal_records >= self.compact_every:
+            self.compact()
+        return len(new)
+
+    def compact(self):
+        """Fold the journal into a new snapshot, copying records without parsing them."""
+        snapshot = Snapshot(self._snapshot_path) if self._snapshot_count else None
+        try:
+            records = []
+            if snapshot is not None:
+                tokens = snapshot.content_tokens()
+                records = [(snapshot.record(i), tokens[i]) for i in range(len(snapshot))]
+            records += [(data, orjson.loads(data).get("content_tokens") or 0) for data in self._journal_messages]
+            meta = self._meta if self._meta is not None else (orjson.dumps(snapshot.meta) if snapshot else b"{}")
+            Snapshot.write(self._snapshot_path, records, meta, self._generation + 1)
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+        open(self._journal_path, "wb").close()
+        self._generation += 1
+        self._snapshot_count = len(records)
+        self._journal_messages, self._meta, self._journal_records = [], None, 0
+
+    def rewrite(self, session: CommonChatSession):
+        """Replace everything on disk with the given session."""
+        records = [(_dump_message(m), m.content_tokens) for m in session.messages]
+        Snapshot.write(self._snapshot_path, records, _dump_meta(session), self._generation + 1)
+        open(self._journal_path, "wb").close()
+        self._generation += 1
+        self._snapshot_count = len(records)
+        self._journal_messages, self._meta, self._journal_records = [], None, 0
+
+    def exists(self) -> bool:
+        return self.count > 0 or self._meta is not None or os.path.exists(self._snapshot_path)
+
+    def load(self, cls=ChatGPTSession, **overrides) -> CommonChatSession:
+        """Rebuild the session with a lazily parsed history. Pass auth= to restore the api key."""
+        snapshot = Snapshot(self._snapshot_path) if os.path.exists(self._snapshot_path) else None
+        meta = orjson.loads(self._meta) if self._meta is not None else (snapshot.meta if snapshot else {})
+        meta.update(overrides)
+        meta.setdefault("auth", {"api_key": SecretStr(os.getenv("OPENAI_API_KEY", ''))})
+        session = cls(**meta)
+        session.messages = LazyMessages(snapshot, list(self._journal_messages))
+        return session
@@ -0,0 +1,104 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Optional
+
+import httpx
+
+
+class TokenBucket:
+    """Continuously refilling bucket of `capacity` units per `period` seconds.
+
+    reserve() takes the units right away and lets the level go negative,
+    returning how long the caller has to wait. Waits are handed out in call
+    order, so callers are admitted first come first served.
+    """
+
+    def __init__(self, capacity: float, period: float = 60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # a single request larger than the bucket would never fit, let it drain the bucket instead
+        amount = min(amount, self.capacity)
+        self.level -= amount
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+
+class RateLimiter:
+    """Client side requests/min and tokens/min limits shared by every session in the process."""
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None,
+                 max_retries: int = 5, backoff: float = 1.0, max_backoff: float = 60.0):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # set on a 429, nobody is admitted before it
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.blocked_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(tokens, now))
+            return wait
+
+    def acquire(self, tokens: int = 0) -> float:
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, tokens: int = 0) -> float:
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """Seconds until `error` may be retried, None if it shouldn't be.
+        The next acquire() waits for it, there is no need to sleep separately."""
+        if attempt >= self.max_retries:
+            return None
+        if not isinstance(error, httpx.HTTPStatusError) or error.response.status_code != 429:
+            return None
+        delay = None
+        retry_after = error.response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                delay = None
+        if delay is None:
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt) * (0.5 + random.random() / 2)
+        # everyone sharing this limiter backs off, not just the caller that got the 429
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        return delay
+
+
+_DEFAULT_RATE_LIMITER: Optional[RateLimiter] = None
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    return _DEFAULT_RATE_LIMITER
+
+
+def set_rate_limiter(limiter: Optional[RateLimiter]):
+    """Install the process-wide limiter used by sessions without their own, None disables it."""
+    global _DEFAULT_RATE_LIMITER
+    _DEFAULT_RATE_LIMITER = limiter
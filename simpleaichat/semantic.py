@@ -0,0 +1,107 @@
+import hashlib
+import threading
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+def hashing_embedding(text: str, dim: int = 256) -> List[float]:
+    """Deterministic bag of character trigrams, a local stand-in for a real embedding model."""
+    vec = np.zeros(dim, dtype=np.float32)
+    text = f"  {text.lower()} "
+    for i in range(len(text) - 2):
+        h = int.from_bytes(hashlib.blake2b(text[i:i + 3].encode(), digest_size=4).digest(), "little")
+        vec[h % dim] += 1.0
+    return vec.tolist()
+
+
+class VectorIndex:
+    """Contiguous float32 matrix of unit vectors, searched with one matrix-vector product."""
+
+    def __init__(self, dim: int, maxsize: Optional[int] = None, capacity: int = 1024):
+        self.dim = dim
+        self.maxsize = maxsize
+        self.vectors = np.empty((capacity if maxsize is None else min(capacity, maxsize), dim), dtype=np.float32)
+        self.values: List[str] = []
+        self.added = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, vector: np.ndarray, value: str):
+        n = len(self.values)
+        if self.maxsize is not None and n >= self.maxsize:
+            # full, overwrite the oldest entry
+            i = self.added % self.maxsize
+            self.vectors[i] = vector
+            self.values[i] = value
+        else:
+            if n == len(self.vectors):
+                grow = 2 * n if self.maxsize is None else min(2 * n, self.maxsize)
+                vectors = np.empty((grow, self.dim), dtype=np.float32)
+                vectors[:n] = self.vectors
+                self.vectors = vectors
+            self.vectors[n] = vector
+            self.values.append(value)
+        self.added += 1
+
+    def search(self, vector: np.ndarray):
+        # returns (similarity, value) of the nearest neighbour
+        n = len(self.values)
+        if n == 0:
+            return -1.0, None
+        sims = self.vectors[:n] @ vector
+        i = int(np.argmax(sims))
+        return float(sims[i]), self.values[i]
+
+
+class SemanticCache:
+    """Returns a stored answer when a new prompt is close enough to a past one.
+
+    Prompts are grouped by system message, so the same question asked to
+    different characters is never shared. `embed` maps text to a vector and
+    can be any callable, e.g. an embeddings api or hashing_embedding.
+    """
+
+    def __init__(self, embed: Callable[[str], Sequence[float]] = hashing_embedding,
+                 threshold: float = 0.95, maxsize: Optional[int] = None):
+        self.embed_func = embed
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._indexes: Dict[str, VectorIndex] = {}
+        self._lock = threading.Lock()
+
+    def embed(self, text: str) -> List[float]:
+        return list(self.embed_func(text))
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def lookup(self, system: str, embedding: Sequence[float]) -> Optional[str]:
+        vec = self._normalize(embedding)
+        with self._lock:
+            index = self._indexes.get(system)
+            sim, value = index.search(vec) if index is not None else (-1.0, None)
+            if value is not None and sim >= self.threshold:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return None
+
+    def add(self, system: str, embedding: Sequence[float], answer: str):
+        vec = self._normalize(embedding)
+        with self._lock:
+            index = self._indexes.get(system)
+            if index is None:
+                index = self._indexes[system] = VectorIndex(len(vec), self.maxsize)
+            index.add(vec, answer)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / total if total else 0.0,
+                    size=sum(len(i) for i in self._indexes.values()))
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import shutil
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, Optional, Union
+from uuid import UUID
+
+from chatgpt import ChatGPTSession
+from persistence import SessionJournal
+from simpleaichat import ModelSessionFactory
+
+
+class SessionManager:
+    """Bounded in-memory set of sessions, backed by SessionJournal directories under `root`.
+
+    The least recently used sessions past `max_hot` are checkpointed to disk and
+    dropped from memory; get() brings them back by id. A session that is evicted
+    while a caller still holds it is never reloaded from disk, get() returns that
+    same object (turns added after the eviction reach disk with its next checkpoint).
+    Safe to share between threads, the a* methods run disk work in the default
+    executor for asyncio.
+    """
+
+    def __init__(self, root: str = "sessions", max_hot: int = 1000,
+                 factory: Callable[..., ChatGPTSession] = ModelSessionFactory.buildChatGPTSession,
+                 compact_every: int = 1000, lock_stripes: int = 64, **load_kwargs):
+        self.root = root
+        self.max_hot = max_hot
+        self.factory = factory
+        self.compact_every = compact_every
+        # passed to SessionJournal.load, e.g. auth= so rehydrated sessions get the api key back
+        self.load_kwargs = load_kwargs
+        os.makedirs(root, exist_ok=True)
+        self._hot: "OrderedDict[str, ChatGPTSession]" = OrderedDict()
+        # evicted but still being written, a get() in the meantime takes them back
+        self._evicting: Dict[str, ChatGPTSession] = {}
+        # every session handed out and still referenced somewhere, so there is one object per id
+        self._live: "weakref.WeakValueDictionary[str, ChatGPTSession]" = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        # disk access to one session directory is serialized by its stripe
+        self._stripes = [threading.Lock() for _ in range(lock_stripes)]
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+        self.creates = 0
+
+    @staticmethod
+    def _key(id: Union[str, UUID]) -> str:
+        return str(id)
+
+    def _stripe(self, key: str) -> threading.Lock:
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _journal(self, key: str) -> SessionJournal:
+        return SessionJournal(os.path.join(self.root, key), compact_every=self.compact_every)
+
+    def _take_hot(self, key: str) -> Optional[ChatGPTSession]:
+        # caller holds self._lock
+        session = self._hot.get(key)
+        if session is not None:
+            self._hot.move_to_end(key)
+            return session
+        session = self._evicting.get(key)
+        if session is None:
+            session = self._live.get(key)
+        if session is not None:
+            self._hot[key] = session
+        return session
+
+    def new_session(self, **config) -> ChatGPTSession:
+        session = self.factory(**config)
+        with self._lock:
+            self.creates += 1
+        self.put(session)
+        return session
+
+    def put(self, session: ChatGPTSession):
+        with self._lock:
+            self._hot[self._key(session.id)] = session
+            self._hot.move_to_end(self._key(session.id))
+            self._live[self._key(session.id)] = session
+        self._evict_overflow()
+
+    def get(self, id: Union[str, UUID]) -> ChatGPTSession:
+        key = self._key(id)
+        with self._lock:
+            session = self._take_hot(key)
+            if session is not None:
+                self.hits += 1
+                return session
+            self.misses += 1
+        with self._stripe(key):
+            with self._lock:
+                # another thread may have loaded it while we waited
+                session = self._take_hot(key)
+            if session is None:
+                journal = self._journal(key)
+                if not journal.exists():
+                    raise KeyError(id)
+                session = journal.load(**self.load_kwargs)
+                with self._lock:
+                    self.loads += 1
+                    self._hot[key] = session
+                    self._live[key] = session
+        self._evict_overflow()
+        return session
+
+    def checkpoint(self, id: Union[str, UUID]) -> int:
+        key = self._key(id)
+        with self._lock:
+            session = self._hot.get(key) or self._evicting.get(key) or self._live.get(key)
+        if session is None:
+            return 0
+        with self._stripe(key):
+            return self._journal(key).checkpoint(session)
+
+    def checkpoint_all(self):
+        for key in self.ids():
+            self.checkpoint(key)
+
+    def _evict_overflow(self):
+        while True:
+            with self._lock:
+                if len(self._hot) <= self.max_hot:
+                    return
+                key, session = self._hot.popitem(last=False)
+                self._evicting[key] = session
+                self.evictions += 1
+            try:
+                with self._stripe(key):
+                    self._journal(key).checkpoint(session)
+            finally:
+                with self._lock:
+                    if self._evicting.get(key) is session:
+                        del self._evicting[key]
+
+    def evict(self, id: Union[str, UUID]):
+        key = self._key(id)
+        with self._lock:
+            session = self._hot.pop(key, None)
+            if session is None:
+                return
+            self._evicting[key] = session
+            self.evictions += 1
+        try:
+            with self._stripe(key):
+                self._journal(key).checkpoint(session)
+        finally:
+            with self._lock:
+                if self._evicting.get(key) is session:
+                    del self._evicting[key]
+
+    def delete(self, id: Union[str, UUID]):
+        key = self._key(id)
+        with self._lock:
+            self._hot.pop(key, None)
+            self._evicting.pop(key, None)
+            self._live.pop(key, None)
+        with self._stripe(key):
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+    def ids(self) -> Iterator[str]:
+        with self._lock:
+            return iter(list(self._hot))
+
+    def __contains__(self, id) -> bool:
+        key = self._key(id)
+        with self._lock:
+            if key in self._hot or key in self._evicting or key in self._live:
+                return True
+        return os.path.isdir(os.path.join(self.root, key))
+
+    def __len__(self) -> int:
+        return len(self._hot)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return dict(hot=len(self._hot), hits=self.hits, misses=self.misses, loads=self.loads,
+                        evictions=self.evictions, creates=self.creates,
+                        hit_rate=self.hits / total if total else 0.0)
+
+    ############################# asyncio ##############################
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def aget(self, id: Union[str, UUID]) -> ChatGPTSession:
+        key = self._key(id)
+        with self._lock:
+            session = self._take_hot(key)
+            if session is not None:
+                self.hits += 1
+                return session
+        return await self._run(self.get, id)
+
+    async def anew_session(self, **config) -> ChatGPTSession:
+        return await self._run(lambda: self.new_session(**config))
+
+    async def acheckpoint(self, id: Union[str, UUID]) -> int:
+        return await self._run(self.checkpoint, id)
+
+    async def aevict(self, id: Union[str, UUID]):
+        return await self._run(self.evict, id)
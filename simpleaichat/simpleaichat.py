@@ -29,7 +29,7 @@ class ModelSessionFactory:
         gpt_role: Optional[str] = 'assistant',
         gpt_name: Optional[str] = 'GPT',
         temperature : Optional[float] = 0.7,
-        n: Optional[float] = 1,
+        n: Optional[int] = 1,
         max_tokens: Optional[int] = 1024,
         top_p: Optional[int] = 1,
         presence_penalty : Optional[float] = 0.0,
@@ -0,0 +1,107 @@
+import asyncio
+from typing import List, Optional
+
+SUMMARY_PROMPT = ("Summarize the following part of a tool result. Keep every fact, number, name "
+                  "and link that could answer a question about it, drop boilerplate.")
+# characters per token when the session has no encoder
+CHARS_PER_TOKEN = 4
+
+
+class ToolOutputPolicy:
+    """Decides how much of a tool result goes into the history.
+
+    Results longer than `max_tokens` (counted with the session's encoder) are
+    cut down before they are added:
+      "head"      keeps the first max_tokens tokens
+      "head_tail" keeps the first head_ratio of the budget and the end of the result
+      "summarize" summarizes chunk_tokens sized chunks with the session's model,
+                  then summarizes the summaries until they fit (map-reduce)
+    The full result is kept on the session, see ChatGPTSession.get_tool_result,
+    for the last `keep_results` shortened results and at most `keep_chars`
+    characters in total (None for no limit). They only live in memory: they are
+    not written by SessionJournal and are gone once SessionManager evicts the session.
+    """
+
+    MODES = ("head", "head_tail", "summarize")
+
+    def __init__(self, max_tokens: int = 2000, mode: str = "head_tail", head_ratio: float = 0.7,
+                 chunk_tokens: int = 4000, summary_prompt: str = SUMMARY_PROMPT, max_rounds: int = 3,
+                 keep_results: Optional[int] = 64, keep_chars: Optional[int] = 1 << 23):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown mode {mode}, expected one of {self.MODES}")
+        self.max_tokens = max_tokens
+        self.mode = mode
+        self.head_ratio = head_ratio
+        self.chunk_tokens = chunk_tokens
+        self.summary_prompt = summary_prompt
+        self.max_rounds = max_rounds
+        self.keep_results = keep_results
+        self.keep_chars = keep_chars
+
+    ############ token helpers, chars stand in for tokens when there is no encoder
+
+    @staticmethod
+    def _tokens(session, text: str):
+        encoder = session.get_token_encoder()
+        return encoder, (encoder.encode(text) if encoder is not None else text)
+
+    @staticmethod
+    def _size(tokens) -> int:
+        return len(tokens) if not isinstance(tokens, str) else -(-len(tokens) // CHARS_PER_TOKEN)
+
+    @staticmethod
+    def _slice(encoder, tokens, start: int, end: Optional[int]) -> str:
+        if encoder is None:
+            return tokens[start * CHARS_PER_TOKEN:None if end is None else end * CHARS_PER_TOKEN]
+        return encoder.decode(tokens[start:end])
+
+    def _note(self, funcname: str, size: int, ref: str) -> str:
+        return f"\n[{funcname} returned {size} tokens, shortened to about {self.max_tokens}. full result: {ref}]"
+
+    def _cut(self, encoder, tokens, size: int) -> str:
+        if self.mode == "head":
+            return self._slice(encoder, tokens, 0, self.max_tokens)
+        head = int(self.max_tokens * self.head_ratio)
+        tail = self.max_tokens - head
+        text = self._slice(encoder, tokens, 0, head)
+        if tail:
+            text += "\n...\n" + self._slice(encoder, tokens, size - tail, None)
+        return text
+
+    def _chunks(self, encoder, tokens, size: int) -> List[str]:
+        return [self._slice(encoder, tokens, i, i + self.chunk_tokens) for i in range(0, size, self.chunk_tokens)]
+
+    ############ apply
+
+    def apply(self, session, funcname: str, text: str, ref: str) -> str:
+        """The content that goes into the history for `text`."""
+        encoder, tokens = self._tokens(session, text)
+        size = self._size(tokens)
+        if size <= self.max_tokens:
+            return text
+        if self.mode != "summarize":
+            return self._cut(encoder, tokens, size) + self._note(funcname, size, ref)
+        for _ in range(self.max_rounds):
+            text = "\n".join(session.summarize_text(chunk, self.summary_prompt)
+                             for chunk in self._chunks(encoder, tokens, self._size(tokens)))
+            encoder, tokens = self._tokens(session, text)
+            if self._size(tokens) <= self.max_tokens:
+                return text + self._note(funcname, size, ref)
+        return self._cut(encoder, tokens, self._size(tokens)) + self._note(funcname, size, ref)
+
+    async def aapply(self, session, funcname: str, text: str, ref: str) -> str:
+        encoder, tokens = self._tokens(session, text)
+        size = self._size(tokens)
+        if size <= self.max_tokens:
+            return text
+        if self.mode != "summarize":
+            return self._cut(encoder, tokens, size) + self._note(funcname, size, ref)
+        for _ in range(self.max_rounds):
+            # chunks are summarized concurrently
+            summaries = await asyncio.gather(*[session.asummarize_text(chunk, self.summary_prompt)
+                                               for chunk in self._chunks(encoder, tokens, self._size(tokens))])
+            text = "\n".join(summaries)
+            encoder, tokens = self._tokens(session, text)
+            if self._size(tokens) <= self.max_tokens:
+                return text + self._note(funcname, size, ref)
+        return self._cut(encoder, tokens, self._size(tokens)) + self._note(funcname, size, ref)
@@ -1,33 +1,21 @@
 from models import CommonMessage, CommonChatSession, Function
 from utils import wikipedia_search, wikipedia_search_lookup
-from pathlib import Path
-from sys import platform
+import asyncio
 from typing import TYPE_CHECKING, Optional, Type
 
-from bs4 import BeautifulSoup
-from selenium.common.exceptions import WebDriverException
-from selenium.webdriver.chrome.options import Options as ChromeOptions
-from selenium.webdriver.chrome.service import Service as ChromeDriverService
-from selenium.webdriver.chrome.webdriver import WebDriver as ChromeDriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.options import ArgOptions as BrowserOptions
-from selenium.webdriver.edge.options import Options as EdgeOptions
-from selenium.webdriver.edge.service import Service as EdgeDriverService
-from selenium.webdriver.edge.webdriver import WebDriver as EdgeDriver
-from selenium.webdriver.firefox.options import Options as FirefoxOptions
-from selenium.webdriver.firefox.service import Service as GeckoDriverService
-from selenium.webdriver.firefox.webdriver import WebDriver as FirefoxDriver
-from selenium.webdriver.remote.webdriver import WebDriver
-from selenium.webdriver.safari.options import Options as SafariOptions
-from selenium.webdriver.safari.webdriver import WebDriver as SafariDriver
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.wait import WebDriverWait
-from webdriver_manager.chrome import ChromeDriverManager
-from webdriver_manager.firefox import GeckoDriverManager
-from webdriver_manager.microsoft import EdgeChromiumDriverManager as EdgeDriverManager
+from extract import html_to_text
+from fetch import PageFetcher, UnsupportedContentType, get_page_fetcher
+
+# bs4 and selenium load on first use, importing the tools (and chatgpt) stays cheap
+if TYPE_CHECKING:
+    from selenium.webdriver.remote.webdriver import WebDriver
+    from browser import BrowserPool
+
 
 class WikipediaSearch(Function):
     description: str = 'search information from wiki and get topics'
+    _cacheable = True
+    _cache_ttl = 3600
     _parameters_description = dict(
         query='the key words use for searching'
     )
@@ -43,6 +31,8 @@ class WikipediaSearch(Function):
 
 class WikipediaLookup(Function):
     description: str = 'lookup more information about a topic.'
+    _cacheable = True
+    _cache_ttl = 3600
     _parameters_description = dict(
         query='the key words use for lookup'
     )
@@ -56,18 +46,29 @@ class WikipediaLookup(Function):
 
 class BrowseLink(Function):
     description: str = 'browse the information from the link.'
+    # None uses the process-wide pool from browser.get_browser_pool()
+    _browser_pool: Optional["BrowserPool"] = None
+    # None uses fetch.get_page_fetcher(), static pages never reach the browser
+    _page_fetcher: Optional[PageFetcher] = None
+    # stop extracting page text after this many characters, None keeps it all
+    _max_chars: Optional[int] = None
     _parameters_description = dict(
         link='URL link to browse.'
     )
     def __call__(self, link: str):
         page,_ = self.browse_website(link)
         return page
+
+    async def acall(self, link: str):
+        page,_ = await self.abrowse_website(link)
+        return page
     
     def __init__(self, *args,**kwargs):
         super(self.__class__, self).__init__(*args,**kwargs)
         self._extract_signature()
 
     def _parse_qiita(self, html_doc :str):
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(html_doc, 'html.parser')
         # Extract title
         # title = soup.title.text
@@ -88,24 +89,57 @@ class BrowseLink(Function):
         return article_body
     
 
+    def get_browser_pool(self) -> "BrowserPool":
+        if self._browser_pool is not None:
+            return self._browser_pool
+        from browser import get_browser_pool
+        return get_browser_pool()
+
+    def set_browser_pool(self, pool: "BrowserPool"):
+        self._browser_pool = pool
+        self._page_fetcher = None
+        return self
+
+    def get_page_fetcher(self) -> PageFetcher:
+        if self._page_fetcher is None:
+            if self._browser_pool is None:
+                return get_page_fetcher()
+            self._page_fetcher = PageFetcher(self._browser_pool)
+        return self._page_fetcher
+
+    def set_page_fetcher(self, fetcher: PageFetcher):
+        self._page_fetcher = fetcher
+        return self
+
+    def _page_text(self, url: str, page_source: str) -> str:
+        page = self.scrape_text_with_selenium(url, page_source)
+        # the qiita parser returns a tag, everything else plain text
+        return page if isinstance(page, str) else page.text
+
     def browse_website(self, url: str) -> str:
-        driver = None
         text,links = 'can not open the link!','can not open the link!'
         try:
-            driver = self.open_page_in_browser(url)
-            page_source = driver.execute_script("return document.body.outerHTML;")
-
-            page = self.scrape_text_with_selenium(url, page_source)
-            text = page.text
+            page_source,_ = self.get_page_fetcher().fetch(url)
+            text = self._page_text(url, page_source)
             links = ''#scrape_links_with_selenium(driver, url)
             
+        except UnsupportedContentType as e:
+            text = str(e)
         except Exception as e:
             print(e)
-        finally:
-            if driver:
-                driver.quit()
-            
-            return text,links
+        return text,links
+
+    async def abrowse_website(self, url: str) -> str:
+        text,links = 'can not open the link!','can not open the link!'
+        try:
+            page_source,_ = await self.get_page_fetcher().afetch(url)
+            text = await asyncio.get_running_loop().run_in_executor(None, self._page_text, url, page_source)
+            links = ''
+        except UnsupportedContentType as e:
+            text = str(e)
+        except Exception as e:
+            print(e)
+        return text,links
 
     def scrape_text_with_selenium(self, link :str, page_source: str) -> str:
         """Scrape text from a browser window using selenium
@@ -121,79 +155,30 @@ class BrowseLink(Function):
         # page_source = driver.execute_script("return document.body.outerHTML;")
         if 'https://qiita.com' in link:
             return self._parse_qiita(page_source)
-        
-        soup = BeautifulSoup(page_source, "html.parser")
-
-        for script in soup(["script", "style"]):
-            script.extract()
+        # selectolax/lxml when installed, only the first _max_chars characters are extracted
+        return html_to_text(page_source, self._max_chars)
 
-        text = soup.get_text()
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = "\n".join(chunk for chunk in chunks if chunk)
-        return text
 
-
-    def scrape_links_with_selenium(self, driver: WebDriver, base_url: str) -> list[str]:
+    def scrape_links_with_selenium(self, driver: "WebDriver", base_url: str) -> list[str]:
         pass
 
 
-    def open_page_in_browser(self, url: str, selenium_web_browser:str='chrome', selenium_headless:bool=True) -> WebDriver:
-        """Open a browser window and load a web page using Selenium
+    def open_page_in_browser(self, url: str, selenium_web_browser:str='chrome', selenium_headless:bool=True) -> "WebDriver":
+        """Open a new browser window and load a web page using Selenium, the caller quits it.
+        browse_website uses the shared BrowserPool instead.
 
         Params:
             url (str): The URL of the page to load
-            config (Config): The applicable application configuration
 
         Returns:
             driver (WebDriver): A driver object representing the browser window to scrape
         """
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.wait import WebDriverWait
+        from browser import new_driver
 
-        options_available: dict[str, Type[BrowserOptions]] = {
-            "chrome": ChromeOptions,
-            "edge": EdgeOptions,
-            "firefox": FirefoxOptions,
-            "safari": SafariOptions,
-        }
-
-        options: BrowserOptions = options_available[selenium_web_browser]()
-        options.add_argument(
-            "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/112.0.5615.49 Safari/537.36"
-        )
-
-        if selenium_web_browser == "firefox":
-            if selenium_headless:
-                options.headless = True
-                options.add_argument("--disable-gpu")
-            driver = FirefoxDriver(
-                service=GeckoDriverService(GeckoDriverManager().install()), options=options
-            )
-        elif selenium_web_browser == "edge":
-            driver = EdgeDriver(
-                service=EdgeDriverService(EdgeDriverManager().install()), options=options
-            )
-        elif selenium_web_browser == "safari":
-            # Requires a bit more setup on the users end
-            # See https://developer.apple.com/documentation/webkit/testing_with_webdriver_in_safari
-            driver = SafariDriver(options=options)
-        else:
-            if platform == "linux" or platform == "linux2":
-                options.add_argument("--disable-dev-shm-usage")
-                options.add_argument("--remote-debugging-port=9222")
-
-            options.add_argument("--no-sandbox")
-            if selenium_headless:
-                options.add_argument("--headless=new")
-                options.add_argument("--disable-gpu")
-
-            chromium_driver_path = Path("/usr/bin/chromedriver")
-
-            driver = ChromeDriver(
-                service=ChromeDriverService(str(chromium_driver_path))
-                if chromium_driver_path.exists()
-                else ChromeDriverService(ChromeDriverManager().install()),
-                options=options,
-            )
+        driver = new_driver(selenium_web_browser, selenium_headless, debugging_port=9222)
         driver.get(url)
 
         WebDriverWait(driver, 10).until(
@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import weakref
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+import httpx
+import orjson
+
+
+def auth_headers(api_key: str) -> Dict[str, str]:
+    return {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+
+
+def parse_sse_line(line: str) -> Optional[Dict[str, Any]]:
+    # returns the chunk of a "data: {...}" line, None for keep-alives and comments
+    if not line.startswith("data:"):
+        return None
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return None
+    return orjson.loads(data)
+
+
+class ChatTransport:
+    """Pooled HTTP client for chat completions endpoints.
+
+    Holds one keep-alive httpx.Client and one httpx.AsyncClient per event loop.
+    The api key is sent per request, so a transport can be shared by sessions with different auth.
+    """
+
+    def __init__(
+        self,
+        max_connections: Optional[int] = 100,
+        max_keepalive_connections: Optional[int] = 20,
+        keepalive_expiry: Optional[float] = 30.0,
+        timeout: Optional[float] = 600.0,
+        connect_timeout: Optional[float] = 10.0,
+        http2: bool = False,
+        transport: Optional[httpx.BaseTransport] = None,
+        async_transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        # http2 needs the optional h2 package (pip install httpx[http2])
+        self.http2 = http2
+        self._transport = transport
+        self._async_transport = async_transport
+        self._client: Optional[httpx.Client] = None
+        self._lock = threading.Lock()
+        # an httpx connection pool can't be shared across event loops
+        self._async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None or self._client.is_closed:
+            with self._lock:
+                if self._client is None or self._client.is_closed:
+                    self._client = httpx.Client(limits=self.limits, timeout=self.timeout,
+                                                http2=self.http2, transport=self._transport)
+        return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None or client.is_closed:
+            client = self._async_clients[loop] = httpx.AsyncClient(limits=self.limits, timeout=self.timeout,
+                                                                   http2=self.http2, transport=self._async_transport)
+        return client
+
+    def _request(self, client, url: str, api_key: str, payload: Dict[str, Any], timeout) -> httpx.Request:
+        return client.build_request("POST", url, content=orjson.dumps(payload), headers=auth_headers(api_key),
+                                    timeout=httpx.USE_CLIENT_DEFAULT if timeout is None else timeout)
+
+    def post(self, url: str, api_key: str, payload: Dict[str, Any], timeout=None) -> Dict[str, Any]:
+        r = self.client.send(self._request(self.client, url, api_key, payload, timeout))
+        r.raise_for_status()
+        return orjson.loads(r.content)
+
+    def stream(self, url: str, api_key: str, payload: Dict[str, Any], timeout=None) -> Iterator[Dict[str, Any]]:
+        # the request is sent right away so http errors surface here, not on first iteration
+        r = self.client.send(self._request(self.client, url, api_key, payload, timeout), stream=True)
+        if r.is_error:
+            r.read()
+            r.close()
+            r.raise_for_status()
+        return self._iter_sse(r)
+
+    def _iter_sse(self, r: httpx.Response) -> Iterator[Dict[str, Any]]:
+        try:
+            for line in r.iter_lines():
+                chunk = parse_sse_line(line)
+                if chunk is not None:
+                    yield chunk
+        finally:
+            r.close()
+
+    async def apost(self, url: str, api_key: str, payload: Dict[str, Any], timeout=None) -> Dict[str, Any]:
+        client = self.async_client
+        r = await client.send(self._request(client, url, api_key, payload, timeout))
+        r.raise_for_status()
+        return orjson.loads(r.content)
+
+    async def astream(self, url: str, api_key: str, payload: Dict[str, Any], timeout=None) -> AsyncIterator[Dict[str, Any]]:
+        client = self.async_client
+        r = await client.send(self._request(client, url, api_key, payload, timeout), stream=True)
+        if r.is_error:
+            await r.aread()
+            await r.aclose()
+            r.raise_for_status()
+        return self._aiter_sse(r)
+
+    async def _aiter_sse(self, r: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+        try:
+            async for line in r.aiter_lines():
+                chunk = parse_sse_line(line)
+                if chunk is not None:
+                    yield chunk
+        finally:
+            await r.aclose()
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+
+    async def aclose(self):
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+_DEFAULT_TRANSPORT: Optional[ChatTransport] = None
+_DEFAULT_TRANSPORT_LOCK = threading.Lock()
+
+
+def get_default_transport() -> ChatTransport:
+    global _DEFAULT_TRANSPORT
+    if _DEFAULT_TRANSPORT is None:
+        with _DEFAULT_TRANSPORT_LOCK:
+            if _DEFAULT_TRANSPORT is None:
+                _DEFAULT_TRANSPORT = ChatTransport()
+    return _DEFAULT_TRANSPORT
+
+
+def set_default_transport(transport: ChatTransport):
+    global _DEFAULT_TRANSPORT
+    _DEFAULT_TRANSPORT = transport
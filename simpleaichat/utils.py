@@ -1,8 +1,67 @@
+import logging
 import os
-from typing import List, Union
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Union
 from pydantic import Field
-
-WIKIPEDIA_API_URL = "https://en.wikipedia.org/w/api.php"
+import httpx
+
+# sent by the browse tools, plain http fetches and selenium alike
+USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+              "(KHTML, like Gecko) Chrome/112.0.5615.49 Safari/537.36")
+# overridable, e.g. to point the wikipedia tools at a local stand-in server
+WIKIPEDIA_API_URL = os.getenv("WIKIPEDIA_API_URL", "https://en.wikipedia.org/w/api.php")
+
+# process-wide tiktoken encoders, resolved once per model name.
+# models tiktoken doesn't know are cached as None so they don't pay for the exception again.
+_TOKEN_ENCODERS: Dict[str, Any] = {}
+_TOKEN_ENCODERS_LOCK = threading.Lock()
+# other failures (tiktoken downloads its BPE files on first use) are retried after this many seconds
+TOKEN_ENCODER_RETRY = 30.0
+_TOKEN_ENCODER_FAILURES: Dict[str, float] = {}
+
+
+def get_token_encoder(model: str) -> Optional[Any]:
+    try:
+        return _TOKEN_ENCODERS[model]
+    except KeyError:
+        pass
+    failed = _TOKEN_ENCODER_FAILURES.get(model)
+    if failed is not None and time.monotonic() - failed < TOKEN_ENCODER_RETRY:
+        return None
+    with _TOKEN_ENCODERS_LOCK:
+        if model in _TOKEN_ENCODERS:
+            return _TOKEN_ENCODERS[model]
+        failed = _TOKEN_ENCODER_FAILURES.get(model)
+        if failed is not None and time.monotonic() - failed < TOKEN_ENCODER_RETRY:
+            return None
+        try:
+            # imported here, tiktoken costs its import only to processes that count tokens
+            import tiktoken
+            encoder = tiktoken.encoding_for_model(model)
+        except (ImportError, KeyError):
+            # no tiktoken or an unknown model, that won't change
+            _TOKEN_ENCODERS[model] = None
+        except Exception as e:
+            _TOKEN_ENCODER_FAILURES[model] = time.monotonic()
+            logging.getLogger("simpleaichat").warning(
+                "no token encoder for %s, retrying in %.0fs: %r", model, TOKEN_ENCODER_RETRY, e)
+            return None
+        else:
+            _TOKEN_ENCODERS[model] = encoder
+            _TOKEN_ENCODER_FAILURES.pop(model, None)
+        return _TOKEN_ENCODERS[model]
+
+
+def warmup_token_encoders(models: Iterable[str] = ("gpt-3.5-turbo", "gpt-4")) -> Dict[str, bool]:
+    # call at startup so the first request doesn't load the BPE files
+    return {m: get_token_encoder(m) is not None for m in models}
+
+
+def clear_token_encoders():
+    with _TOKEN_ENCODERS_LOCK:
+        _TOKEN_ENCODERS.clear()
+        _TOKEN_ENCODER_FAILURES.clear()
 
 
 def wikipedia_search(query: str, n: int = 1) -> Union[str, List[str]]:
@@ -52,7 +111,7 @@ async def wikipedia_search_async(query: str, n: int = 1) -> Union[str, List[str]
         "srprop": "",
     }
 
-    async with httpx.AsyncClient(proxies=os.getenv("https_proxy")) as client:
+    async with httpx.AsyncClient() as client:
         r_search = await client.get(WIKIPEDIA_API_URL, params=SEARCH_PARAMS)
     results = [x["title"] for x in r_search.json()["query"]["search"]]
 
@@ -71,7 +130,7 @@ async def wikipedia_lookup_async(query: str, sentences: int = 1) -> str:
         "titles": query,
     }
 
-    async with httpx.AsyncClient(proxies=os.getenv("https_proxy")) as client:
+    async with httpx.AsyncClient() as client:
         r_lookup = await client.get(WIKIPEDIA_API_URL, params=LOOKUP_PARAMS)
     return r_lookup.json()["query"]["pages"][0]["extract"]
 
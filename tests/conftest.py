@@ -0,0 +1,50 @@
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import orjson
+import pytest
+
+# the package modules import each other flat (from models import ...)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "simpleaichat"))
+
+
+class WikiHandler(BaseHTTPRequestHandler):
+    """Answers the two queries utils.wikipedia_search / wikipedia_lookup send."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlsplit(self.path).query).items()}
+        self.server.queries.append(params)
+        if params.get("list") == "search":
+            n = int(params.get("srlimit", 1))
+            body = {"query": {"search": [{"title": f"{params['srsearch']} {i}"} for i in range(n)]}}
+        else:
+            body = {"query": {"pages": [{"extract": f"all about {params['titles']}"}]}}
+        data = orjson.dumps(body)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def wiki_server(monkeypatch):
+    """Local stand-in for the wikipedia api, .queries holds the query params of every request."""
+    import utils
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), WikiHandler)
+    httpd.daemon_threads = True
+    httpd.queries = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    host, port = httpd.server_address[:2]
+    monkeypatch.setattr(utils, "WIKIPEDIA_API_URL", f"http://{host}:{port}/w/api.php")
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
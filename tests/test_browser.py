@@ -0,0 +1,34 @@
+import pytest
+from selenium.common.exceptions import InvalidSessionIdException, TimeoutException
+
+from browser import BrowserPool
+
+
+class FakeDriver:
+    def __init__(self):
+        self.quit_called = False
+
+    def quit(self):
+        self.quit_called = True
+
+
+def test_page_timeout_keeps_the_browser():
+    pool = BrowserPool(size=1, factory=FakeDriver)
+    with pytest.raises(TimeoutException):
+        with pool.borrow() as driver:
+            raise TimeoutException("slow page")
+    assert not driver.quit_called
+    with pool.borrow() as again:
+        assert again is driver
+    assert (pool.stats()["crashed"], pool.stats()["started"]) == (0, 1)
+
+
+def test_lost_session_replaces_the_browser():
+    pool = BrowserPool(size=1, factory=FakeDriver)
+    with pytest.raises(InvalidSessionIdException):
+        with pool.borrow() as driver:
+            raise InvalidSessionIdException("gone")
+    assert driver.quit_called
+    with pool.borrow() as again:
+        assert again is not driver
+    assert (pool.stats()["crashed"], pool.stats()["started"]) == (1, 2)
@@ -0,0 +1,10 @@
+import pytest
+
+from extract import available_engines, html_to_text
+
+
+@pytest.mark.parametrize("engine", available_engines())
+def test_xml_declaration_with_encoding(engine):
+    page = '<?xml version="1.0" encoding="utf-8"?>\n<html><body><p>héllo</p><script>x()</script></body></html>'
+    assert html_to_text(page, engine=engine) == 'héllo'
+    assert html_to_text('<?xml version="1.0" encoding="utf-8"?>', engine=engine) == ''
@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+import pytest
+
+from fetch import FAST, PageFetcher, UnsupportedContentType
+from tools import BrowseLink
+
+TEXT = "<html><body><p>" + "readable words " * 30 + "</p></body></html>"
+PAGES = {
+    "/page": ("text/html; charset=utf-8", TEXT.encode()),
+    "/data": ("application/json", b'{"words": "' + b"many " * 60 + b'"}'),
+    "/paper.pdf": ("application/pdf", b"%PDF-1.7 binary"),
+    "/blob": ("application/octet-stream", b"\x00\x01\x02"),
+}
+
+
+class NoBrowser:
+    def fetch(self, url):
+        raise AssertionError(f"escalated {url}")
+
+
+def _handler(request):
+    content_type, body = PAGES[request.url.path]
+    return httpx.Response(200, headers={"content-type": content_type}, content=body)
+
+
+def _fetcher():
+    return PageFetcher(NoBrowser(), transport=httpx.MockTransport(_handler),
+                       async_transport=httpx.MockTransport(_handler))
+
+
+def test_text_pages_take_the_fast_path():
+    fetcher = _fetcher()
+    for path in ("/page", "/data"):
+        assert fetcher.fetch("http://site" + path)[1] == FAST
+
+
+@pytest.mark.parametrize("path", ["/paper.pdf", "/blob"])
+def test_binary_pages_are_unsupported(path):
+    fetcher = _fetcher()
+    with pytest.raises(UnsupportedContentType):
+        fetcher.fetch("http://site" + path)
+    with pytest.raises(UnsupportedContentType):
+        asyncio.run(fetcher.afetch("http://site" + path))
+    assert fetcher.stats() == {}
+
+
+def test_browse_tool_reports_the_content_type():
+    tool = BrowseLink()
+    tool.set_page_fetcher(_fetcher())
+    text, _ = tool.browse_website("http://site/paper.pdf")
+    assert "unsupported content-type application/pdf" in text
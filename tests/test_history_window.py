@@ -0,0 +1,53 @@
+from models import CommonMessage
+from simpleaichat import ModelSessionFactory
+
+
+def _tool_turn_session():
+    ss = ModelSessionFactory.buildChatGPTSession(max_tokens=0)
+    ss.messages = [
+        CommonMessage(role='user', content='hi', content_tokens=2),
+        CommonMessage(role='assistant', content='', content_tokens=28, tool_calls=[
+            {'id': 'call_0', 'type': 'function', 'function': {'name': 'WikipediaSearch', 'arguments': '{"query": "x"}'}}]),
+        CommonMessage(role='tool', content='{"titles": ["x"]}', content_tokens=17, tool_call_id='call_0'),
+        CommonMessage(role='assistant', content='done', content_tokens=23),
+        CommonMessage(role='user', content='again', content_tokens=5),
+    ]
+    ss.system_message.content_tokens = 0
+    return ss
+
+
+def test_message_count_window_takes_in_the_call():
+    ss = _tool_turn_session()
+    ss.recent_messages = 3
+    assert [m['role'] for m in ss.get_messages_dict()] == ['system', 'assistant', 'tool', 'assistant', 'user']
+
+
+def test_token_window_skips_past_the_tool_group():
+    ss = _tool_turn_session()
+    ss.token_window = True
+    for context_window in range(60, 200, 5):
+        ss.context_window = context_window
+        roles = [m['role'] for m in ss.get_messages_dict()]
+        assert roles[1] != 'tool', (context_window, roles)
+        assert roles[-1] == 'user'
+
+
+def test_window_ending_in_tool_results_keeps_the_call():
+    ss = _tool_turn_session()
+    del ss.messages[3:]
+    ss.recent_messages = 1
+    assert [m['role'] for m in ss.get_messages_dict()] == ['system', 'assistant', 'tool']
+    ss.recent_messages, ss.token_window, ss.context_window = 0, True, 30
+    assert [m['role'] for m in ss.get_messages_dict()] == ['system', 'assistant', 'tool']
+
+
+def test_context_window_of_dated_and_unknown_models(caplog):
+    ss = ModelSessionFactory.buildChatGPTSession()
+    for model, window in (('gpt-3.5-turbo-0613', 4096), ('gpt-3.5-turbo-0125', 16385), ('gpt-4-1106-preview', 128000),
+                          ('gpt-4-turbo-2024-04-09', 128000), ('gpt-4o-2024-05-13', 128000)):
+        ss.model = model
+        assert ss.get_context_window() == window, model
+    ss.model = 'local-model-for-window-test'
+    assert ss.get_context_window() == 4096
+    assert ss.get_context_window() == 4096
+    assert sum('local-model-for-window-test' in r.getMessage() for r in caplog.records) == 1
@@ -0,0 +1,35 @@
+import pytest
+
+from models import CommonMessage
+from persistence import SessionJournal
+from simpleaichat import ModelSessionFactory
+
+
+def _session(n):
+    ss = ModelSessionFactory.buildChatGPTSession()
+    ss.messages = [CommonMessage(role='user', content=f'm{i}') for i in range(n)]
+    return ss
+
+
+@pytest.mark.parametrize("op", ["compact", "rewrite"])
+def test_crash_before_journal_truncate_does_not_replay(tmp_path, op):
+    journal = SessionJournal(str(tmp_path), compact_every=10**9)
+    journal.checkpoint(_session(3))
+    with open(journal._journal_path, 'rb') as f:
+        stale = f.read()
+    journal.compact() if op == "compact" else journal.rewrite(_session(3))
+    # the snapshot was replaced, the journal truncate never happened
+    with open(journal._journal_path, 'wb') as f:
+        f.write(stale)
+    reopened = SessionJournal(str(tmp_path))
+    assert [m.content for m in reopened.load().messages] == ['m0', 'm1', 'm2']
+    reopened.checkpoint(_session(5))
+    assert [m.content for m in SessionJournal(str(tmp_path)).load().messages] == ['m0', 'm1', 'm2', 'm3', 'm4']
+
+
+def test_journal_after_compaction_is_replayed(tmp_path):
+    journal = SessionJournal(str(tmp_path), compact_every=10**9)
+    journal.checkpoint(_session(2))
+    journal.compact()
+    journal.checkpoint(_session(4))
+    assert [m.content for m in SessionJournal(str(tmp_path)).load().messages] == ['m0', 'm1', 'm2', 'm3']
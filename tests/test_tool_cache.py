@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+import pytest
+
+import models
+from models import Function
+from simpleaichat import ModelSessionFactory
+from tools import WikipediaLookup, WikipediaSearch
+from utils import wikipedia_search
+
+
+class ShortLivedSearch(Function):
+    description: str = 'search information from wiki and get topics'
+    _cacheable = True
+    _cache_ttl = 0.2
+    _cache_maxsize = 2
+    _parameters_description = dict(
+        query='the key words use for searching'
+    )
+    def __call__(self, query: str):
+        return {"titles": wikipedia_search(query, n=3)}
+
+    def __init__(self, *args,**kwargs):
+        super(self.__class__, self).__init__(*args,**kwargs)
+        self._extract_signature()
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    # result caches are process wide, one per tool class
+    models._RESULT_CACHES.clear()
+    yield
+    models._RESULT_CACHES.clear()
+
+
+def _searches(server):
+    return [q["srsearch"] for q in server.queries if q.get("list") == "search"]
+
+
+def test_hits_and_misses(wiki_server):
+    tool = WikipediaSearch()
+    first = tool.call(query="python")
+    assert tool.call(query="python") == first
+    assert WikipediaSearch().call(query="python") == first
+    tool.call(query="rust")
+    assert _searches(wiki_server) == ["python", "rust"]
+    stats = WikipediaSearch.cache_stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (2, 2, 2)
+    assert stats["hit_rate"] == 0.5
+
+
+def test_lookup_caches_both_requests(wiki_server):
+    assert WikipediaLookup().call(query="python") == "all about python 0"
+    WikipediaLookup().call(query="python")
+    assert len(wiki_server.queries) == 2
+    assert WikipediaLookup.cache_stats()["hits"] == 1
+
+
+def test_not_cacheable_tools_have_no_cache():
+    class Plain(Function):
+        description: str = 'plain'
+        def __call__(self, x: str):
+            return x
+    assert Plain.result_cache() is None
+    assert Plain.cache_stats() is None
+    assert Plain().cache_get({"x": "a"}) == (None, None)
+
+
+def test_argument_order_does_not_matter():
+    assert Function._cache_key({"a": 1, "b": 2}) == Function._cache_key({"b": 2, "a": 1})
+
+
+def test_ttl_expiry(wiki_server):
+    tool = ShortLivedSearch()
+    tool.call(query="python")
+    tool.call(query="python")
+    assert len(_searches(wiki_server)) == 1
+    time.sleep(0.3)
+    tool.call(query="python")
+    assert len(_searches(wiki_server)) == 2
+    assert ShortLivedSearch.cache_stats()["misses"] == 2
+
+
+def test_maxsize_evicts_least_recently_used(wiki_server):
+    tool = ShortLivedSearch()
+    for q in ("a", "b", "a", "c", "a", "b"):
+        tool.call(query=q)
+    # "b" was the oldest when "c" came in
+    assert _searches(wiki_server) == ["a", "b", "c", "b"]
+    assert len(ShortLivedSearch.result_cache()) == 2
+
+
+def test_session_call_tool_uses_the_cache(wiki_server):
+    ss = ModelSessionFactory.buildChatGPTSession()
+    tools_prompt = ss._tools_prompt([WikipediaSearch()])
+    first = ss._call_tool(tools_prompt, "WikipediaSearch", '{"query": "python"}')
+    second = ss._call_tool(tools_prompt, "WikipediaSearch", '{"query": "python"}')
+    assert first == second == ({"query": "python"}, {"titles": ["python 0", "python 1", "python 2"],
+                                                     "context": "python 0, python 1, python 2"})
+    assert len(_searches(wiki_server)) == 1
+
+
+def test_async_call_tool_uses_the_cache(wiki_server):
+    ss = ModelSessionFactory.buildChatGPTSession()
+    tools_prompt = ss._tools_prompt([WikipediaSearch()])
+
+    async def run():
+        first = await ss._acall_tool(tools_prompt, "WikipediaSearch", '{"query": "python"}')
+        # a hit is answered on the loop, no request and no executor
+        second = await ss._acall_tool(tools_prompt, "WikipediaSearch", '{"query": "python"}')
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second
+    assert len(_searches(wiki_server)) == 1
+    # the sync and async paths share one cache
+    assert ss._call_tool(tools_prompt, "WikipediaSearch", '{"query": "python"}') == first
+    stats = WikipediaSearch.cache_stats()
+    assert (stats["hits"], stats["misses"]) == (2, 1)
@@ -0,0 +1,17 @@
+from simpleaichat import ModelSessionFactory
+from tooloutput import ToolOutputPolicy
+
+
+def test_full_results_are_bounded():
+    ss = ModelSessionFactory.buildChatGPTSession()
+    ss.set_tool_output_policy(ToolOutputPolicy(max_tokens=5, mode="head", keep_results=2, keep_chars=250))
+    for i in range(4):
+        ss._shape_tool_result('f', 'x' * 100, f'c{i}')
+    assert ss.get_tool_result('c0') is None
+    assert ss.get_tool_result('c3') == 'x' * 100
+    ss._shape_tool_result('f', 'y' * 200, 'c4')
+    assert list(ss._tool_results) == ['c4']
+    # larger than keep_chars on its own
+    ss._shape_tool_result('f', 'z' * 300, 'c5')
+    assert ss.get_tool_result('c5') is None and ss._tool_results_chars == 0
+    assert not ModelSessionFactory.buildChatGPTSession()._tool_results
@@ -0,0 +1,45 @@
+import orjson
+
+from simpleaichat import ModelSessionFactory
+from tools import BrowseLink, WikipediaLookup, WikipediaSearch
+
+TOOLS = (WikipediaSearch, WikipediaLookup, BrowseLink)
+
+
+def test_schema_size_constant_after_many_instantiations():
+    for cls in TOOLS:
+        schema, data = cls.openai_schema()
+        for _ in range(1000):
+            tool = cls()
+        assert cls.openai_schema()[0] is schema
+        assert cls.openai_schema()[1] == data
+        assert orjson.dumps(tool.get_openai_fragment()) == data
+        assert len(orjson.dumps(tool.get_openai_description())) == len(data)
+        assert tool.required == schema["parameters"]["required"]
+        assert len(tool.required) == 1
+
+
+def test_instances_do_not_share_mutables():
+    a, b = WikipediaSearch(), WikipediaSearch()
+    a.required.append("extra")
+    a.parameters["properties"]["extra"] = {"type": "string"}
+    assert b.required == ["query"]
+    assert "extra" not in b.parameters["properties"]
+    assert WikipediaSearch.openai_schema()[0]["parameters"]["required"] == ["query"]
+
+
+def test_payload_size_constant_across_sessions_and_requests():
+    sizes = set()
+    for _ in range(20):
+        ss = ModelSessionFactory.buildChatGPTSession()
+        tools_prompt = ss._tools_prompt([cls() for cls in TOOLS])
+        for _ in range(5):
+            payload = ss.openai_chat_completion_payload(tools_description=[t[1] for t in tools_prompt.values()])
+            sizes.add(len(orjson.dumps(payload)))
+    assert len(sizes) == 1
+
+
+def test_custom_description_does_not_touch_the_shared_schema():
+    tool = WikipediaSearch(description="custom")
+    assert orjson.loads(orjson.dumps(tool.get_openai_fragment()))["description"] == "custom"
+    assert WikipediaSearch.openai_schema()[0]["description"] == WikipediaSearch.model_fields["description"].default